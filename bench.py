@@ -0,0 +1,357 @@
+"""Офлайн нагрузочный стенд для обработчиков бота
+
+Симулирует N чатов: каждый упоминает бота с командой, игроки записываются
+и голосуют за карты, затем по расписанию объявляются победители. Bot и
+JobQueue подменены фейками, поэтому сеть не нужна. Время до объявлений
+сжимается в --time-scale раз.
+
+Пример: python bench.py --chats 500 --voters 8 --api-latency 5
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytz
+from telegram import Update
+
+import main
+from storage import MemoryBackend, SQLiteBackend, StateStore
+
+
+class FakeBot:
+    """Bot без сети: запоминает опросы и считает вызовы API"""
+
+    def __init__(self, latency: float):
+        self.username = main.BOT_TAG.lstrip("@")
+        self.latency = latency  # секунды на каждый вызов API
+        self.calls = defaultdict(int)
+        self.polls = {}  # (chat_id, message_id): варианты
+        self._ids = itertools.count(1)
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_poll(self, chat_id: int, question: str, options: List[str], **kwargs):
+        await self._call("sendPoll")
+        message_id = next(self._ids)
+        self.polls[(chat_id, message_id)] = options
+        return SimpleNamespace(message_id=message_id, poll=SimpleNamespace(id=f"poll{message_id}"))
+
+    async def stop_poll(self, chat_id: int, message_id: int, **kwargs):
+        await self._call("stopPoll")
+        options = self.polls.get((chat_id, message_id), [])
+        return SimpleNamespace(options=[SimpleNamespace(text=text, voter_count=0) for text in options])
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call("sendMessage")
+
+
+class FakeJob:
+    def __init__(self, callback, due: float, data, chat_id, name):
+        self.callback = callback
+        self.due = due  # время цикла событий, когда задача должна сработать
+        self.data = data
+        self.chat_id = chat_id
+        self.name = name
+        self.handle = None
+
+    def schedule_removal(self):
+        self.handle.cancel()
+
+
+class FakeJobQueue:
+    """JobQueue на таймерах цикла событий со сжатием времени"""
+
+    def __init__(self, bot: FakeBot, time_scale: float, stats: 'Stats'):
+        self.bot = bot
+        self.time_scale = time_scale
+        self.stats = stats
+        self.jobs: Dict[str, List[FakeJob]] = defaultdict(list)
+        self.pending = set()
+
+    def run_once(self, callback, when: float, data=None, name=None, chat_id=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        job = FakeJob(callback, loop.time() + when * self.time_scale, data, chat_id, name)
+        job.handle = loop.call_later(when * self.time_scale, self._fire, job)
+        self.jobs[name].append(job)
+        self.pending.add(job)
+        return job
+
+    def get_jobs_by_name(self, name: str) -> List[FakeJob]:
+        return [job for job in self.jobs.get(name, []) if job in self.pending]
+
+    def _fire(self, job: FakeJob):
+        self.stats.lateness.append(asyncio.get_running_loop().time() - job.due)
+        task = asyncio.ensure_future(self.stats.timed("announce_winner_maps", job.callback(self.context(job))))
+        task.add_done_callback(lambda _: self.pending.discard(job))
+
+    def context(self, job: FakeJob = None) -> SimpleNamespace:
+        return SimpleNamespace(bot=self.bot, job_queue=self, job=job)
+
+    async def drain(self):
+        """Дождаться срабатывания и выполнения всех задач"""
+        while self.pending:
+            self.pending = {job for job in self.pending if not job.handle.cancelled()}
+            await asyncio.sleep(0.01)
+
+
+class Stats:
+    def __init__(self, trace_memory: bool = False):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.lateness: List[float] = []
+        self.updates = 0
+        # С trace_memory: байты, выделенные сверх уже занятых на пике вызова и оставшиеся после него
+        self.trace_memory = trace_memory
+        self.allocated: Dict[str, List[int]] = defaultdict(list)
+        self.retained: Dict[str, List[int]] = defaultdict(list)
+        self._events = 0  # начала и концы вызовов
+
+    async def timed(self, name: str, coro):
+        if self.trace_memory:
+            self._events += 1
+            mark = self._events
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.latency[name].append(time.perf_counter() - start)
+            if self.trace_memory:
+                # Замер годится, только если за время вызова не начинался и не заканчивался другой
+                if self._events == mark:
+                    current, peak = tracemalloc.get_traced_memory()
+                    self.allocated[name].append(peak - before)
+                    self.retained[name].append(current - before)
+                self._events += 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def format_row(name: str, values: List[float]) -> str:
+    ms = [value * 1000 for value in values]
+    return (
+        f"{name:<28} {len(ms):>7} {percentile(ms, 0.5):>9.3f} {percentile(ms, 0.9):>9.3f} "
+        f"{percentile(ms, 0.99):>9.3f} {max(ms):>9.3f}"
+    )
+
+
+def format_memory_row(name: str, allocated: List[int], retained: List[int]) -> str:
+    return (
+        f"{name:<28} {len(allocated):>7} {percentile(allocated, 0.5):>9} {percentile(allocated, 0.99):>9} "
+        f"{percentile(retained, 0.5):>9} {percentile(retained, 0.99):>9}"
+    )
+
+
+class Simulation:
+    def __init__(self, args, stats: Stats):
+        self.args = args
+        self.stats = stats
+        self.bot = FakeBot(args.api_latency / 1000)
+        self.job_queue = FakeJobQueue(self.bot, args.time_scale, stats)
+        self.update_ids = itertools.count(1)
+        self.rng = random.Random(args.seed)
+
+    def update(self, payload: dict) -> Update:
+        payload["update_id"] = next(self.update_ids)
+        self.stats.updates += 1
+        return Update.de_json(payload, self.bot)
+
+    def mention_update(self, chat_id: int, text: str, mention: str = main.BOT_TAG) -> Update:
+        return self.update({
+            "message": {
+                "message_id": next(self.update_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                "text": text,
+                "entities": [{"type": "mention", "offset": 0, "length": len(mention)}],
+            }
+        })
+
+    def poll_update(self, poll_id: str, options: List[str], counts: List[int], voters: int) -> Update:
+        return self.update({
+            "poll": {
+                "id": poll_id,
+                "question": "bench",
+                "options": [{"text": text, "voter_count": count} for text, count in zip(options, counts)],
+                "total_voter_count": voters,
+                "is_closed": False,
+                "is_anonymous": True,
+                "type": "regular",
+                "allows_multiple_answers": True,
+            }
+        })
+
+    def poll_answer_update(self, poll_id: str, user_id: int, option_ids: List[int]) -> Update:
+        return self.update({
+            "poll_answer": {
+                "poll_id": poll_id,
+                "user": {"id": user_id, "is_bot": False, "first_name": "player"},
+                "option_ids": option_ids,
+            }
+        })
+
+    def filter_mention(self, update: Update):
+        start = time.perf_counter()
+        try:
+            return main.mention_filter.check_update(update)
+        finally:
+            self.stats.latency["mention_filter"].append(time.perf_counter() - start)
+
+    async def run_chat(self, chat_id: int, now: datetime, delay: float):
+        # Чаты приходят потоком с заданной частотой, а не все разом
+        await asyncio.sleep(delay)
+        # Большая часть упоминаний в группах адресована не боту
+        for player in range(self.args.foreign_mentions):
+            update = self.mention_update(chat_id, f"@player{player} го играть", f"@player{player}")
+            self.filter_mention(update)
+
+        context = self.job_queue.context()
+        game_time = now + timedelta(minutes=self.rng.randint(6, 120))
+        text = f"{main.BOT_TAG} {game_time.strftime('%H:%M')} {self.rng.randint(1, 3)}"
+        update = self.mention_update(chat_id, text)
+        context.mention_command = self.filter_mention(update)['mention_command']
+        await self.stats.timed("handle_mention", main.handle_mention(update, context))
+
+        state = await main.state_store.get(chat_id)
+        # Игра, созданная этой командой, добавлена последней
+        poll_data = next(reversed(state.polls.values()), None)
+        if not poll_data:
+            return
+
+        options = [main.option_label(map_id) for map_id in poll_data['tally'].options]
+        counts = [0] * len(options)
+        for voter in range(self.args.voters):
+            user_id = chat_id * 100 + voter
+            answer = [0] if self.rng.random() < 0.8 else [2]
+            update = self.poll_answer_update(poll_data['registration_poll_key'], user_id, answer)
+            await self.stats.timed("handle_poll_answer", main.handle_poll_answer(update, context))
+
+            for option in self.rng.sample(range(len(options)), self.rng.randint(1, 3)):
+                counts[option] += 1
+            update = self.poll_update(poll_data['map_poll_key'], options, counts, voter + 1)
+            await self.stats.timed("handle_poll", main.handle_poll(update, context))
+
+            await asyncio.sleep(0)
+
+    async def run(self) -> float:
+        """Прогнать все чаты, вернуть время обработки обновлений"""
+        main.state_store = StateStore(
+            SQLiteBackend(self.args.db) if self.args.db else MemoryBackend(),
+            main.ChatState.from_dict
+        )
+        main.poll_chats.clear()
+        main.mention_filter.username = self.bot.username.lower()
+
+        now = datetime.now(main.TIMEZONE)
+        start = time.perf_counter()
+        if self.stats.trace_memory:
+            # Замер памяти на вызов требует, чтобы обработчики не перекрывались
+            for i in range(self.args.chats):
+                await self.run_chat(-(1000 + i), now, 0)
+        else:
+            await asyncio.gather(*(
+                self.run_chat(-(1000 + i), now, i / self.args.rate) for i in range(self.args.chats)
+            ))
+        elapsed = time.perf_counter() - start
+
+        await self.job_queue.drain()
+        await main.state_store.close()
+        return elapsed
+
+
+def bench_selection(args, stats: Stats):
+    """Замерить выбор карт на пуле заданного размера"""
+    names = list(main.ALL_MAPS) + [f"Workshop map {i}" for i in range(max(0, args.pool_size - len(main.ALL_MAPS)))]
+    pool = main.MapPool(main.MapRegistry(names))
+    rng = random.Random(args.seed)
+
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        options = main.select_map_options(pool)
+        stats.latency["select_map_options"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        main.get_random_map_not_in_list(pool, set(options))
+        stats.latency["get_random_map_not_in_list"].append(time.perf_counter() - start)
+
+        pool.record_winners(rng.sample(options[:-1], min(2, len(options) - 1)))
+
+
+def pin_timezone_to_noon():
+    """Сдвинуть часовой пояс бота так, чтобы сейчас был полдень
+
+    Команды указывают только HH:MM, поэтому ближе к полуночи время игры
+    ушло бы на следующий день и команды отклонялись бы как прошедшие.
+    """
+    utc_now = datetime.now(pytz.utc)
+    offset = (12 * 60 - (utc_now.hour * 60 + utc_now.minute)) % 1440
+    if offset > 720:
+        offset -= 1440
+    main.TIMEZONE = pytz.FixedOffset(offset)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный стенд MatchMaker")
+    parser.add_argument("--chats", type=int, default=200, help="сколько чатов симулировать")
+    parser.add_argument("--voters", type=int, default=8, help="игроков, голосующих в каждом чате")
+    parser.add_argument("--foreign-mentions", type=int, default=5, help="упоминаний других людей на чат")
+    parser.add_argument("--rate", type=float, default=100, help="новых чатов в секунду")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка фейкового API, мс")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="сжатие времени до объявлений")
+    parser.add_argument("--pool-size", type=int, default=len(main.ALL_MAPS), help="размер пула для выбора карт")
+    parser.add_argument("--iterations", type=int, default=2000, help="итераций выбора карт")
+    parser.add_argument("--db", help="путь к SQLite, по умолчанию состояние в памяти")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def main_bench():
+    args = parse_args()
+    logging.getLogger("main").setLevel(logging.WARNING)
+    pin_timezone_to_noon()
+    random.seed(args.seed)
+
+    # Проход для задержек
+    stats = Stats()
+    simulation = Simulation(args, stats)
+    elapsed = asyncio.run(simulation.run())
+    bench_selection(args, stats)
+
+    # Отдельный последовательный проход с tracemalloc, чтобы трассировка не искажала задержки
+    alloc_stats = Stats(trace_memory=True)
+    tracemalloc.start()
+    asyncio.run(Simulation(args, alloc_stats).run())
+    tracemalloc.stop()
+
+    print(f"Чатов: {args.chats} ({args.rate:g}/с), игроков: {args.voters}, задержка API: {args.api_latency} мс")
+    print(f"Обновлений: {stats.updates}, за {elapsed:.3f} с, {stats.updates / elapsed:.0f} обновлений/с")
+    print("Вызовов API: " + ", ".join(f"{method} {count}" for method, count in simulation.bot.calls.items()))
+    print()
+    print(f"{'обработчик, мс':<28} {'вызовов':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, values in stats.latency.items():
+        print(format_row(name, values))
+    if stats.lateness:
+        print(format_row("опоздание объявлений", stats.lateness))
+    print()
+    print(f"{'память за вызов, Б':<28} {'вызовов':>7} {'выд. p50':>9} {'выд. p99':>9} {'уд. p50':>9} {'уд. p99':>9}")
+    for name, allocated in alloc_stats.allocated.items():
+        print(format_memory_row(name, allocated, alloc_stats.retained[name]))
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -1,28 +1,78 @@
 import os
+import asyncio
+import functools
 import logging
+import math
 import random
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from typing import List, Tuple
+import re
+from datetime import datetime, time, timedelta
+from collections import Counter, defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import pytz
 
-from telegram import Update
+from telegram import Bot, Message, MessageEntity, Update
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
+    JobQueue,
     MessageHandler,
+    PollAnswerHandler,
+    PollHandler,
     filters
 )
 
+import metrics
+from metrics import timed_handler
+from ratelimit import GLOBAL_RATE, PRIORITY_ANNOUNCE, PRIORITY_ERROR, ChatQueueFull, PriorityRateLimiter
+from storage import MemoryBackend, SQLiteBackend, StateStore
+from votelog import VoteLog
+
 # Конфигурация
 BOT_NAME = "MatchMaker"
 BOT_TAG = "@cs_maps_bot"
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 TIMEZONE = pytz.timezone('Europe/Moscow')  # Укажите свою временную зону
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")  # sqlite или memory
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "matchmaker.db")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "5"))  # секунды
+VOTE_LOG_DIR = os.environ.get("VOTE_LOG_DIR", "votes")  # журнал голосований, пусто - не вести
+VOTE_LOG_SEGMENT_BYTES = int(os.environ.get("VOTE_LOG_SEGMENT_BYTES", str(1 << 20)))
+VOTE_LOG_RETENTION_DAYS = float(os.environ.get("VOTE_LOG_RETENTION_DAYS", "0"))  # 0 - хранить всё
+CATCHUP_CONCURRENCY = int(os.environ.get("CATCHUP_CONCURRENCY", "5"))  # просроченных объявлений одновременно
+BACKLOG_LIMIT = int(os.environ.get("BACKLOG_LIMIT", "10000"))  # обновлений за простой при старте, 0 - как обычные
+EARLY_CLOSE_PLAYERS = int(os.environ.get("EARLY_CLOSE_PLAYERS", "10"))  # 0 - не закрывать досрочно
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "256"))  # 1 - обработка по одному
+# Вес карты в выборке удваивается за каждые RECENCY_HALF_LIFE голосований без её победы
+RECENCY_HALF_LIFE = float(os.environ.get("RECENCY_HALF_LIFE", "20"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # например, адрес локального тестового сервера
+
+# Webhook: если задан WEBHOOK_URL, бот принимает обновления по HTTP вместо long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+# Метрики Prometheus: METRICS_PORT=0 отключает эндпоинт
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+SLOW_CALL_SECONDS = float(os.environ.get("SLOW_CALL_SECONDS", "0"))  # 0 - не логировать медленные вызовы
 
 # Константы
 RANDOM_OPTION = "🎲Случайная карта не из этого списка"
+REGISTRATION_OPTIONS = ["+", "+-", "-"]
+# Типы обновлений, которые нужны обработчикам
+ALLOWED_UPDATES = [Update.MESSAGE, Update.POLL, Update.POLL_ANSWER]
+ANNOUNCE_BEFORE = timedelta(minutes=5)  # за сколько до игры объявлять результаты
+POLL_EXPIRY = timedelta(hours=1)  # сколько после начала игры хранить необъявленный опрос
+RECENCY_MAX_EXPONENT = 64  # предел давности победы в периодах RECENCY_HALF_LIFE
+MESSAGE_LIMIT = 4096  # максимальная длина сообщения в Telegram
+EXPORT_FORMATS = ("csv", "jsonl")
+VOTE_LOG_COMPACT_INTERVAL = 3600  # секунды между сжатиями журнала голосований
+POLL_OPTION_LIMIT = 100  # максимальная длина варианта опроса в Telegram
+RANDOM_MAP_ID = -1  # id варианта случайной карты в опросе
 
 # Список карт Counter-Strike
 ALL_MAPS = [
@@ -85,252 +135,884 @@ ALL_MAPS = [
     "🚉Whistle - Маленькая карта на железнодорожной станции"
 ]
 
-# Хранение данных
-active_polls = {}  # chat_id: данные опроса
-map_wins_count = defaultdict(int)  # карта: количество побед
-voting_history = deque(maxlen=10)  # история последних 10 победивших карт
-
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# Периодический сброс состояния не должен засорять лог
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def get_available_maps(exclude_list: List[str] = None) -> List[str]:
-    """Получить список доступных карт (не в кд)"""
-    if exclude_list is None:
-        exclude_list = []
+class MapRegistry:
+    """Справочник карт: компактные id и метаданные в массивах по id
+
+    id карты - индекс в titles и labels. Ключ карты - короткая метка для
+    опроса (название до " - "), по меткам id сохраняются в хранилище, поэтому
+    перестановка или удаление карт в ALL_MAPS не ломают сохранённые состояния.
+    Удалённые карты оставляют в массивах None и в выборе не участвуют.
+    """
+
+    def __init__(self, maps: List[str], ids: Optional[Dict[str, int]] = None):
+        ids = dict(ids or {})
+        labels = [self.label_of(title) for title in maps]
+        if len(set(labels)) != len(labels):
+            raise ValueError("Map labels must be unique")
+
+        # Новым картам выдаём id после уже занятых
+        next_id = max(ids.values(), default=-1) + 1
+        for label in labels:
+            if label not in ids:
+                ids[label] = next_id
+                next_id += 1
+
+        size = max((ids[label] for label in labels), default=-1) + 1
+        self.titles: List[Optional[str]] = [None] * size  # полное название с описанием
+        self.labels: List[Optional[str]] = [None] * size  # подпись варианта в опросе
+        self.ids: Dict[str, int] = {}  # метка: id
+        for title, label in zip(maps, labels):
+            map_id = ids[label]
+            self.titles[map_id] = title
+            self.labels[map_id] = label
+            self.ids[label] = map_id
+        self.active = [ids[label] for label in labels]  # id карт пула в порядке ALL_MAPS
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+    @staticmethod
+    def label_of(title: str) -> str:
+        """Короткая подпись карты, влезающая в вариант опроса"""
+        return title.split(' - ')[0][:POLL_OPTION_LIMIT]
+
+    def is_active(self, map_id) -> bool:
+        return isinstance(map_id, int) and 0 <= map_id < len(self.titles) and self.titles[map_id] is not None
+
+
+class WeightedSampler:
+    """Взвешенный выбор без возвращения с изменением веса за O(1)
+
+    Элементы разложены по корзинам по двоичному порядку веса (math.frexp),
+    внутри корзины веса отличаются не больше чем вдвое. Корзина выбирается
+    пропорционально сумме её весов, элемент внутри - случайно с отбраковкой,
+    которая принимает его с вероятностью не меньше 1/2. Число корзин зависит
+    от разброса весов, а не от числа элементов.
+    """
+
+    def __init__(self):
+        self.weights = {}  # элемент: вес
+        self._buckets = {}  # порядок веса: список элементов
+        self._totals = {}  # порядок веса: сумма весов корзины
+        self._positions = {}  # элемент: позиция в списке своей корзины
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def __contains__(self, item) -> bool:
+        return item in self.weights
+
+    def set(self, item, weight: float):
+        """Добавить элемент или изменить его вес (вес больше нуля)"""
+        if item in self.weights:
+            self.remove(item)
+
+        exponent = math.frexp(weight)[1]
+        bucket = self._buckets.setdefault(exponent, [])
+        self._positions[item] = len(bucket)
+        bucket.append(item)
+        self._totals[exponent] = self._totals.get(exponent, 0.0) + weight
+        self.weights[item] = weight
+
+    def remove(self, item):
+        weight = self.weights.pop(item)
+        exponent = math.frexp(weight)[1]
+        bucket = self._buckets[exponent]
+
+        # Меняем местами с последним элементом корзины и удаляем хвост
+        position = self._positions.pop(item)
+        last = bucket.pop()
+        if last != item:
+            bucket[position] = last
+            self._positions[last] = position
+
+        if bucket:
+            self._totals[exponent] -= weight
+        else:
+            # Пустую корзину убираем целиком, заодно сбрасывая накопленную погрешность суммы
+            del self._buckets[exponent]
+            del self._totals[exponent]
+
+    def draw(self):
+        """Один элемент с вероятностью, пропорциональной весу"""
+        target = random.random() * sum(self._totals.values())
+        for exponent, total in self._totals.items():
+            target -= total
+            if target < 0:
+                break
+
+        bucket = self._buckets[exponent]
+        limit = math.ldexp(1.0, exponent)
+        while True:
+            item = random.choice(bucket)
+            if random.random() * limit < self.weights[item]:
+                return item
+
+    def sample(self, k: int, exclude: Set = frozenset()) -> list:
+        """До k разных элементов не из exclude, без возвращения"""
+        # Исключённые и уже выбранные элементы временно убираем, потом возвращаем
+        removed = [(item, self.weights[item]) for item in exclude if item in self.weights]
+        for item, _ in removed:
+            self.remove(item)
+
+        drawn = []
+        try:
+            while len(drawn) < k and self.weights:
+                item = self.draw()
+                removed.append((item, self.weights[item]))
+                self.remove(item)
+                drawn.append(item)
+        finally:
+            for item, weight in removed:
+                self.set(item, weight)
+        return drawn
+
+
+class MapPool:
+    """Пул карт реестра с окном кд и взвешенным выбором
+
+    Карты внутри пула идентифицируются id из MapRegistry. Карты в кд
+    учитываются счётчиком и в выборе не участвуют. Доступные карты лежат
+    в WeightedSampler с весом 2^(давность последней победы / RECENCY_HALF_LIFE)
+    / (1 + побед), где давность считается в голосованиях этого чата. Вес карты
+    пересчитывается только при выходе из кд, поэтому запись победителей и выбор
+    вариантов не проходят по всему пулу.
+    """
+
+    def __init__(self, registry: MapRegistry, cooldown: int = 10):
+        self.registry = registry
+        self.history = deque(maxlen=cooldown)  # id последних победивших карт
+        self.round = 0  # сколько голосований записано
+        self.wins = Counter()  # id: количество побед
+        self.last_wins = {}  # id: номер голосования последней победы
+        self._all_ids = registry.active
+        self._cooldown = Counter()  # id: сколько раз карта встречается в окне кд
+        self._base = 0  # голосование, от которого отсчитываются веса
+        self._eligible = WeightedSampler()  # доступные (не в кд) карты
+        for map_id in self._all_ids:
+            self._eligible.set(map_id, 1.0)
+
+    def __len__(self) -> int:
+        return len(self._all_ids)
+
+    def fresh(self) -> 'MapPool':
+        """Новый пул с теми же картами и пустыми кд и статистикой"""
+        pool = MapPool.__new__(MapPool)
+        # Реестр общий для всех пулов, копируется только состояние
+        pool.registry = self.registry
+        pool.history = deque(maxlen=self.history.maxlen)
+        pool.round = 0
+        pool.wins = Counter()
+        pool.last_wins = {}
+        pool._all_ids = self._all_ids
+        pool._cooldown = Counter()
+        pool._base = 0
+        pool._eligible = WeightedSampler()
+        for map_id in pool._all_ids:
+            pool._eligible.set(map_id, 1.0)
+        return pool
+
+    def is_on_cooldown(self, map_id: int) -> bool:
+        return map_id in self._cooldown
+
+    def record_winners(self, map_ids: Iterable[int]):
+        """Записать итог голосования: победителей в окно кд и в статистику весов"""
+        self.round += 1
+        map_ids = [map_id for map_id in map_ids if self.registry.is_active(map_id)]
+        for map_id in map_ids:
+            self.wins[map_id] += 1
+            self.last_wins[map_id] = self.round
+        self._push_cooldown(map_ids)
+
+        if self.round - self._base >= RECENCY_HALF_LIFE * RECENCY_MAX_EXPONENT:
+            self._rebase()
+
+    def restore(self, history: Iterable[int], wins: Iterable[Tuple[int, int]],
+                last_wins: Iterable[Tuple[int, int]], round_: int):
+        """Восстановить кд и статистику весов из сохранённого состояния"""
+        # Карты, удалённые из реестра, пропускаем
+        is_active = self.registry.is_active
+        self.round = round_
+        self.wins.clear()
+        self.wins.update({map_id: count for map_id, count in wins if is_active(map_id)})
+        self.last_wins = {map_id: value for map_id, value in last_wins if is_active(map_id)}
+        self._push_cooldown([map_id for map_id in history if is_active(map_id)])
+        self._rebase()
+
+    def sample(self, k: int, exclude: Set[int] = frozenset()) -> List[int]:
+        """Выбрать до k разных карт не в кд и не из exclude с учётом весов"""
+        blocked = sum(1 for map_id in exclude if map_id in self._eligible)
+        if len(self._eligible) > blocked:
+            return self._eligible.sample(k, exclude)
+
+        # Если все карты в кд, выбираем из всех кроме тех что в exclude
+        candidates = [map_id for map_id in self._all_ids if map_id not in exclude]
+        return random.sample(candidates, min(k, len(candidates)))
+
+    def choice(self, exclude: Set[int] = frozenset()) -> Optional[int]:
+        """Выбрать одну карту не в кд и не из exclude"""
+        drawn = self.sample(1, exclude)
+        return drawn[0] if drawn else None
+
+    def weight(self, map_id: int) -> float:
+        # Давность ограничена сверху: карты, не побеждавшие очень давно, равны
+        age = min((self._base - self.last_wins.get(map_id, 0)) / RECENCY_HALF_LIFE, RECENCY_MAX_EXPONENT)
+        return 2.0 ** age / (1 + self.wins[map_id])
+
+    def _push_cooldown(self, map_ids: List[int]):
+        for map_id in map_ids:
+            if len(self.history) == self.history.maxlen:
+                self._release(self.history[0])
+            self.history.append(map_id)
+
+            self._cooldown[map_id] += 1
+            if map_id in self._eligible:
+                self._eligible.remove(map_id)
+
+    def _release(self, map_id: int):
+        self._cooldown[map_id] -= 1
+        if self._cooldown[map_id] <= 0:
+            del self._cooldown[map_id]
+            self._eligible.set(map_id, self.weight(map_id))
+
+    def _rebase(self):
+        # Веса зависят только от разности номеров голосований, поэтому общий
+        # сдвиг точки отсчёта не меняет распределение и удерживает веса в
+        # пределах 2^±RECENCY_MAX_EXPONENT. Пересчёт всех весов - раз в много голосований.
+        self._base = self.round
+        for map_id in list(self._eligible.weights):
+            self._eligible.set(map_id, self.weight(map_id))
+
+
+# main() пересоздаёт реестр с id из хранилища
+map_registry = MapRegistry(ALL_MAPS)
+map_pool = MapPool(map_registry)  # шаблон, из которого создаются пулы чатов
+
+
+class PollTally:
+    """Текущие голоса опроса карт, упорядоченные для объявления
+
+    options - id карт в порядке вариантов опроса (RANDOM_MAP_ID для случайной
+    карты), ranking - индексы вариантов по убыванию голосов, при равенстве
+    сначала карты с меньшим числом побед. При обновлении голосов переставляются
+    только изменившиеся варианты, поэтому топ читается без сортировки.
+    """
+
+    def __init__(self, options: List[int], wins: Dict[int, int],
+                 counts: List[int] = None, voters: int = 0):
+        self.options = options
+        self.counts = list(counts) if counts else [0] * len(options)
+        self.voters = voters  # сколько человек проголосовало
+        self._wins = wins
+        self._positions = [0] * len(options)
+        self.resort()
+
+    def resort(self):
+        """Пересортировать все варианты, например после изменения числа побед"""
+        self.ranking = sorted(range(len(self.options)), key=self._key)
+        for position, option in enumerate(self.ranking):
+            self._positions[option] = position
+
+    def _key(self, option: int) -> Tuple[int, int, int]:
+        return -self.counts[option], self._wins.get(self.options[option], 0), option
+
+    def update(self, counts: List[int], voters: int):
+        """Применить новые количества голосов из обновления опроса"""
+        self.voters = voters
+        for option, count in enumerate(counts):
+            if count != self.counts[option]:
+                self.counts[option] = count
+                self._reposition(option)
+
+    def _reposition(self, option: int):
+        # Сдвигаем вариант вверх или вниз, пока порядок не восстановится
+        ranking = self.ranking
+        position = self._positions[option]
+        key = self._key(option)
+
+        while position > 0 and self._key(ranking[position - 1]) > key:
+            self._swap(position, position - 1)
+            position -= 1
+        while position < len(ranking) - 1 and self._key(ranking[position + 1]) < key:
+            self._swap(position, position + 1)
+            position += 1
+
+    def _swap(self, a: int, b: int):
+        ranking = self.ranking
+        ranking[a], ranking[b] = ranking[b], ranking[a]
+        self._positions[ranking[a]] = a
+        self._positions[ranking[b]] = b
+
+    def ranked_options(self) -> List[int]:
+        return [self.options[option] for option in self.ranking]
+
+    def to_dict(self) -> dict:
+        return {'options': self.options, 'counts': self.counts, 'voters': self.voters}
+
+
+class Leaderboard:
+    """Карты по убыванию числа побед, порядок поддерживается при каждой победе"""
+
+    def __init__(self, wins: Dict[int, int]):
+        self.wins = wins  # общий со статистикой пула, победы засчитывает пул
+        self.order = sorted(wins, key=lambda map_id: -wins[map_id])
+        self._positions = {map_id: i for i, map_id in enumerate(self.order)}
+
+    def promote(self, map_id: int):
+        """Поднять карту на нужное место после засчитанной победы"""
+        position = self._positions.get(map_id)
+        if position is None:
+            position = len(self.order)
+            self.order.append(map_id)
+
+        # Карта обгоняет только тех, у кого побед стало строго меньше
+        order = self.order
+        while position > 0 and self.wins[order[position - 1]] < self.wins[map_id]:
+            order[position] = order[position - 1]
+            self._positions[order[position]] = position
+            position -= 1
+        order[position] = map_id
+        self._positions[map_id] = position
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        return [(map_id, self.wins[map_id]) for map_id in self.order[:n]]
+
+
+class ChatState:
+    """Состояние одного чата: кд карт, статистика побед и запланированные игры"""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.pool = map_pool.fresh()
+        self.wins = self.pool.wins  # id карты: количество побед
+        self.leaderboard = Leaderboard(self.wins)
+        self.polls = {}  # id опроса карт в Telegram: данные игры
+        self.status_cache = None  # готовый текст истории и топа для /status
+        # Команды, меняющие набор игр, ждут сети посреди изменения, поэтому идут по одной
+        self.lock = asyncio.Lock()
+
+    def record_winners(self, winners: List[int]):
+        """Засчитать победы и отправить карты в кд"""
+        self.pool.record_winners(winners)
+        for winner in winners:
+            self.leaderboard.promote(winner)
+        # Победы участвуют в порядке вариантов других открытых игр чата
+        for poll_data in self.polls.values():
+            poll_data['tally'].resort()
+        self.status_cache = None
+
+    def poll_at(self, scheduled_time: datetime) -> Optional[dict]:
+        """Игра, назначенная на это время, или None"""
+        for poll_data in self.polls.values():
+            if poll_data['scheduled_time'] == scheduled_time:
+                return poll_data
+        return None
+
+    def to_dict(self) -> dict:
+        polls = []
+        for poll_data in self.polls.values():
+            poll_data = dict(poll_data)
+            poll_data['scheduled_time'] = poll_data['scheduled_time'].isoformat()
+            poll_data['tally'] = poll_data['tally'].to_dict()
+            poll_data['registered'] = list(poll_data['registered'])
+            polls.append(poll_data)
+
+        return {
+            # Карты хранятся по id, словари - парами [id, значение]
+            'history': list(self.pool.history),
+            'wins': list(self.wins.items()),
+            'round': self.pool.round,
+            'last_wins': list(self.pool.last_wins.items()),
+            'polls': polls,
+        }
+
+    def announce_at(self) -> Optional[float]:
+        """Время ближайшего объявления результатов (epoch) или None"""
+        if not self.polls:
+            return None
+        scheduled_time = min(poll_data['scheduled_time'] for poll_data in self.polls.values())
+        return (scheduled_time - ANNOUNCE_BEFORE).timestamp()
 
-    available = []
-    for map_name in ALL_MAPS:
-        if map_name not in voting_history and map_name not in exclude_list:
-            available.append(map_name)
+    @classmethod
+    def from_dict(cls, chat_id: int, data: Optional[dict]) -> 'ChatState':
+        state = cls(chat_id)
+        if not data:
+            return state
 
-    # Если все карты в кд, возвращаем все кроме тех что в exclude_list
-    if not available:
-        available = [map_name for map_name in ALL_MAPS if map_name not in exclude_list]
+        state.pool.restore(data.get('history', []), data.get('wins', []),
+                           data.get('last_wins', []), data.get('round', 0))
+        state.leaderboard = Leaderboard(state.wins)
 
-    return available
+        polls = data.get('polls', [])
+        if data.get('active_poll'):
+            # Состояние, сохранённое до поддержки нескольких игр в чате; состояния
+            # без подсчёта голосов старше реестра карт и не восстанавливаются
+            polls.append(data['active_poll'])
+        for poll_data in polls:
+            poll_data['scheduled_time'] = datetime.fromisoformat(poll_data['scheduled_time'])
+            tally = poll_data['tally']
+            # Вариант с картой, убранной из реестра, при победе разыгрывается как случайная карта
+            options = [map_id if map_registry.is_active(map_id) else RANDOM_MAP_ID for map_id in tally['options']]
+            poll_data['tally'] = PollTally(options, state.wins, tally['counts'], tally['voters'])
+            poll_data['registered'] = set(poll_data['registered'])
+            state.polls[poll_data['map_poll_key']] = poll_data
 
+        return state
 
-def select_map_options() -> List[str]:
-    """Выбрать 11 случайных карт из доступных и добавить опцию случайной карты"""
-    available_maps = get_available_maps()
 
-    # Выбираем 11 случайных карт, если доступно столько
-    selected_maps = random.sample(available_maps, min(11, len(available_maps)))
+def create_state_store() -> StateStore:
+    """Создать хранилище состояний чатов согласно конфигурации"""
+    if STATE_BACKEND == "sqlite":
+        backend = SQLiteBackend(STATE_DB_PATH)
+    elif STATE_BACKEND == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+
+    return StateStore(backend, ChatState.from_dict)
+
+
+# Хранение данных; main() подменяет хранилище на настроенное
+state_store = StateStore(MemoryBackend(), ChatState.from_dict)
+poll_chats = {}  # id опроса в Telegram: (chat_id, id опроса карт этой игры)
+vote_log = VoteLog(None)  # main() подключает журнал в VOTE_LOG_DIR
+metrics_server = None
+shard = None  # (номер, всего) у воркера shards.py, None - один процесс на все чаты
+overdue_polls = []  # (chat_id, данные игры) просроченных игр воркера до прихода его части бэклога
+
+# У каждого голосования два опроса в индексе
+metrics.ACTIVE_POLLS.set_function(lambda: len(poll_chats) // 2)
+
+
+def index_poll(chat_id: int, poll_data: dict):
+    """Запомнить, какой игре принадлежат опросы, чтобы принимать по ним голоса"""
+    entry = (chat_id, poll_data['map_poll_key'])
+    poll_chats[poll_data['registration_poll_key']] = entry
+    poll_chats[poll_data['map_poll_key']] = entry
+
+
+def unindex_poll(poll_data: dict):
+    poll_chats.pop(poll_data['registration_poll_key'], None)
+    poll_chats.pop(poll_data['map_poll_key'], None)
+
+
+def announcement_job_name(chat_id: int, poll_key: str) -> str:
+    return f"announce:{chat_id}:{poll_key}"
+
+
+def expire_polls(state: ChatState):
+    """Убрать игры, которые давно начались, но так и не были объявлены"""
+    deadline = datetime.now(TIMEZONE) - POLL_EXPIRY
+    expired = [poll_data for poll_data in state.polls.values() if poll_data['scheduled_time'] < deadline]
+    for poll_data in expired:
+        del state.polls[poll_data['map_poll_key']]
+        unindex_poll(poll_data)
+    if expired:
+        state_store.mark_dirty(state.chat_id)
+
+
+def select_map_options(pool: MapPool) -> List[int]:
+    """Выбрать 11 случайных карт из доступных и добавить опцию случайной карты"""
+    selected_maps = pool.sample(11)
 
     # Добавляем опцию случайной карты
-    selected_maps.append(RANDOM_OPTION)
+    selected_maps.append(RANDOM_MAP_ID)
 
     return selected_maps
 
 
-def get_random_map_not_in_list(exclude_list: List[str]) -> str:
-    """Получить случайную карту, которой нет в exclude_list и не в кд"""
-    # Исключаем RANDOM_OPTION из списка
-    exclude_list = [item for item in exclude_list if item != RANDOM_OPTION]
+def get_random_map_not_in_list(pool: MapPool, exclude: Set[int]) -> int:
+    """Получить случайную карту, которой нет в exclude и не в кд"""
+    map_id = pool.choice(exclude)
 
-    available_maps = get_available_maps(exclude_list)
+    if map_id is None:
+        # Если все карты исключены, возвращаем первую карту пула
+        return pool.registry.active[0]
 
-    if not available_maps:
-        # Если нет доступных карт, возвращаем случайную из всех (кроме исключённых)
-        all_maps_excluded = [map_name for map_name in ALL_MAPS if map_name not in exclude_list]
-        if all_maps_excluded:
-            return random.choice(all_maps_excluded)
-        else:
-            # Если все карты исключены, возвращаем первую из ALL_MAPS
-            return ALL_MAPS[0]
+    return map_id
 
-    return random.choice(available_maps)
 
+def option_label(map_id: int) -> str:
+    """Текст варианта опроса для карты"""
+    if map_id == RANDOM_MAP_ID:
+        return RANDOM_OPTION
+    return map_registry.labels[map_id]
 
-async def schedule_map_announcement(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
-                                    scheduled_time: datetime, num_maps: int):
+
+async def schedule_map_announcement(job_queue: JobQueue, chat_id: int, poll_data: dict):
     """Запланировать публикацию результатов за 5 минут до времени"""
-    announcement_time = scheduled_time - timedelta(minutes=5)
+    announcement_time = poll_data['scheduled_time'] - ANNOUNCE_BEFORE
     current_time = datetime.now(TIMEZONE)
 
     if announcement_time > current_time:
         delay = (announcement_time - current_time).total_seconds()
-        context.job_queue.run_once(
+        # В задаче только ключ игры: данные берутся из состояния в момент объявления
+        job_queue.run_once(
             announce_winner_maps,
             delay,
+            name=announcement_job_name(chat_id, poll_data['map_poll_key']),
             chat_id=chat_id,
-            data={'num_maps': num_maps, 'poll_data': active_polls.get(chat_id)}
+            data=poll_data['map_poll_key']
         )
 
 
-async def create_polls(chat_id: int, context: ContextTypes.DEFAULT_TYPE,
-                       num_maps: int, scheduled_time_str: str) -> Tuple[int, int]:
-    """Создать два опроса и вернуть их message_id"""
+def remove_announcement_jobs(job_queue: JobQueue, chat_id: int, poll_key: str):
+    for job in job_queue.get_jobs_by_name(announcement_job_name(chat_id, poll_key)):
+        job.schedule_removal()
+
+
+async def create_polls(state: ChatState, context: ContextTypes.DEFAULT_TYPE,
+                       num_maps: int, scheduled_time_str: str) -> Tuple[Message, Message, List[int]]:
+    """Создать два опроса и вернуть их сообщения и id карт в вариантах опроса"""
     # Опрос регистрации
     registration_poll = await context.bot.send_poll(
-        chat_id=chat_id,
+        chat_id=state.chat_id,
         question=f"Буду в {scheduled_time_str}",
-        options=["+", "+-", "-"],
+        options=REGISTRATION_OPTIONS,
         is_anonymous=False,
         allows_multiple_answers=False
     )
 
     # Опрос выбора карт
-    map_options = select_map_options()
+    map_options = select_map_options(state.pool)
     map_poll = await context.bot.send_poll(
-        chat_id=chat_id,
+        chat_id=state.chat_id,
         question=f"Выберите карты для игры в {scheduled_time_str}",
-        options=map_options,
+        options=[option_label(map_id) for map_id in map_options],
         is_anonymous=True,
         allows_multiple_answers=True
     )
 
-    return registration_poll.message_id, map_poll.message_id
+    return registration_poll, map_poll, map_options
 
 
-async def handle_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик упоминания бота в группе"""
-    if not update.message or not update.message.text:
-        return
+TIME_RE = re.compile(r"(\d{1,2}):(\d{1,2})")
+# Команда после упоминания: "HH:MM количество_карт"
+MENTION_COMMAND_RE = re.compile(r"\s*(\d{1,2}):(\d{1,2})\s+([+-]?\d+)\s*")
 
-    # Проверяем, что сообщение содержит упоминание бота
-    if not context.bot.username or f"@{context.bot.username}" not in update.message.text:
-        return
 
-    # Извлекаем команду после упоминания
-    text = update.message.text.replace(f"@{context.bot.username}", "").strip()
+class BotMentionFilter(filters.MessageFilter):
+    """Пропускает только сообщения с упоминанием самого бота и разбирает команду
 
-    try:
-        # Парсим время и количество карт
-        time_str, num_maps_str = text.split()
+    Упоминания ищутся по сущностям сообщения, поэтому чужие упоминания
+    отсекаются до запуска обработчика. В контекст попадает mention_command:
+    кортеж (время, количество карт) или None, если команда не разобрана.
+    """
+
+    __slots__ = ('username',)
+
+    def __init__(self):
+        super().__init__(name="BotMentionFilter", data_filter=True)
+        self.username = None  # в нижнем регистре, задаётся после getMe
+
+    def filter(self, message: Message) -> Optional[Dict[str, object]]:
+        mentioned, command = self.command(message)
+        if not mentioned:
+            if message.text and self.username:
+                metrics.MENTION_FILTER.inc(result="dropped")
+            return None
+
+        metrics.MENTION_FILTER.inc(result="accepted")
+        return {'mention_command': command}
+
+    def command(self, message: Message) -> Tuple[bool, Optional[Tuple[time, int]]]:
+        """Есть ли в сообщении упоминание бота и команда после него"""
+        text = message.text
+        if not text or not self.username:
+            return False, None
+
+        span = self._find_mention(message)
+        if span is None:
+            return False, None
+
+        start, end = span
+        return True, self.parse(text[:start] + " " + text[end:])
+
+    def _find_mention(self, message: Message) -> Optional[Tuple[int, int]]:
+        """Позиция упоминания бота в тексте (в символах Python) или None"""
+        text = message.text
+        # Смещения сущностей в UTF-16, для ASCII-текста они совпадают с индексами строки
+        ascii_text = text.isascii()
+        for entity in message.entities:
+            if entity.type != MessageEntity.MENTION:
+                continue
 
-        # Проверяем формат времени
-        scheduled_time = datetime.strptime(time_str, "%H:%M").time()
+            if ascii_text:
+                start = entity.offset
+                mention = text[start:start + entity.length]
+            else:
+                mention = message.parse_entity(entity)
+                start = len(text.encode("utf-16-le")[:entity.offset * 2].decode("utf-16-le"))
+
+            if mention[1:].lower() == self.username:
+                return start, start + len(mention)
+
+        return None
+
+    @staticmethod
+    def parse(command: str) -> Optional[Tuple[time, int]]:
+        match = MENTION_COMMAND_RE.fullmatch(command)
+        if not match:
+            return None
+
+        hour, minute, num_maps = match.groups()
+        if int(hour) > 23 or int(minute) > 59:
+            return None
+        return time(int(hour), int(minute)), int(num_maps)
+
+
+mention_filter = BotMentionFilter()
+
+
+def game_datetime(scheduled_time: time) -> datetime:
+    """Время игры сегодняшнего дня в часовом поясе бота"""
+    current_date = datetime.now(TIMEZONE).date()
+    return TIMEZONE.localize(datetime.combine(current_date, scheduled_time))
+
+
+@timed_handler("handle_mention")
+async def handle_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды, адресованной боту через упоминание"""
+    command = context.mention_command
+
+    try:
+        # Время и количество карт уже разобраны фильтром
+        if command is None:
+            raise ValueError("Invalid mention command")
+        scheduled_time, num_maps = command
+        time_str = scheduled_time.strftime("%H:%M")
 
         # Проверяем количество карт
-        num_maps = int(num_maps_str)
         if num_maps < 1 or num_maps > 12:
+            metrics.MENTION_COMMANDS.inc(result="bad_map_count")
             await update.message.reply_text("Количество карт должно быть от 1 до 12")
             return
 
-        # Создаем дату с учетом сегодняшнего дня
-        current_date = datetime.now(TIMEZONE).date()
-        scheduled_datetime = datetime.combine(current_date, scheduled_time)
-        scheduled_datetime = TIMEZONE.localize(scheduled_datetime)
+        scheduled_datetime = game_datetime(scheduled_time)
 
         # Проверяем, что время в будущем
         if scheduled_datetime <= datetime.now(TIMEZONE):
+            metrics.MENTION_COMMANDS.inc(result="past_time")
             await update.message.reply_text("Укажите время в будущем!")
             return
 
-        # Создаем опросы
-        reg_poll_id, map_poll_id = await create_polls(
-            update.message.chat_id,
-            context,
-            num_maps,
-            time_str
-        )
-
-        # Сохраняем информацию об активном опросе
-        map_options = select_map_options()
-        active_polls[update.message.chat_id] = {
-            'registration_poll_id': reg_poll_id,
-            'map_poll_id': map_poll_id,
-            'scheduled_time': scheduled_datetime,
-            'num_maps': num_maps,
-            'map_options': map_options[:-1]  # Сохраняем без RANDOM_OPTION
-        }
-
-        # Планируем объявление результатов
-        await schedule_map_announcement(
-            context,
-            update.message.chat_id,
-            scheduled_datetime,
-            num_maps
-        )
+        state = await state_store.get(update.message.chat_id)
+        async with state.lock:
+            expire_polls(state)
+            # Новая команда на то же время переносит игру: старые опросы закрываются
+            previous = state.poll_at(scheduled_datetime)
+            if previous is not None:
+                await cancel_poll(context, state, previous)
+
+            # Создаем опросы
+            registration_poll, map_poll, map_options = await create_polls(
+                state,
+                context,
+                num_maps,
+                time_str
+            )
+
+            # Сохраняем информацию об игре
+            poll_data = {
+                'registration_poll_id': registration_poll.message_id,
+                'registration_poll_key': registration_poll.poll.id,
+                'map_poll_id': map_poll.message_id,
+                'map_poll_key': map_poll.poll.id,
+                'scheduled_time': scheduled_datetime,
+                'num_maps': num_maps,
+                'tally': PollTally(map_options, state.wins),
+                'registered': set()  # id игроков, ответивших "+"
+            }
+            state.polls[poll_data['map_poll_key']] = poll_data
+            index_poll(state.chat_id, poll_data)
+            state_store.mark_dirty(state.chat_id)
+            metrics.MENTION_COMMANDS.inc(result="accepted")
+
+            # Планируем объявление результатов
+            await schedule_map_announcement(context.job_queue, state.chat_id, poll_data)
 
     except ValueError as e:
+        metrics.MENTION_COMMANDS.inc(result="bad_format")
         await update.message.reply_text(
             "Неверный формат команды. Используйте:\n"
             f"{BOT_TAG} HH:MM количество_карт\n"
             f"Пример: {BOT_TAG} 16:00 2"
         )
     except Exception as e:
+        metrics.MENTION_COMMANDS.inc(result="error")
         logger.error(f"Error creating polls: {e}")
         await update.message.reply_text("Произошла ошибка при создании опросов")
 
 
+@timed_handler("announce_winner_maps")
 async def announce_winner_maps(context: ContextTypes.DEFAULT_TYPE):
-    """Объявить победившие карты"""
+    """Объявить победившие карты по расписанию"""
     job = context.job
-    chat_id = job.chat_id
-    num_maps = job.data['num_maps']
-    poll_data = job.data['poll_data']
+    state = await state_store.get(job.chat_id)
+    poll_data = state.polls.get(job.data)
+    observe_announcement_lag(poll_data)
+    await announce_poll(context.bot, job.chat_id, poll_data)
 
-    if not poll_data or chat_id not in active_polls:
-        return
 
-    try:
-        # Получаем результаты опроса карт
-        map_poll = await context.bot.stop_poll(
-            chat_id,
-            poll_data['map_poll_id']
-        )
+def observe_announcement_lag(poll_data: Optional[dict]):
+    """Запомнить, насколько позже расписания сработало объявление"""
+    if poll_data:
+        due = poll_data['scheduled_time'] - ANNOUNCE_BEFORE
+        metrics.ANNOUNCEMENT_LAG.set((datetime.now(TIMEZONE) - due).total_seconds())
 
-        # Сортируем карты по количеству голосов
-        map_votes = [
-            (option.text, option.voter_count)
-            for option in map_poll.options
-        ]
 
-        # Сортируем: сначала по голосам (убывание), потом по количеству побед (возрастание)
-        map_votes.sort(key=lambda x: (-x[1], map_wins_count.get(x[0], 0)))
+async def announce_poll(bot: Bot, chat_id: int, poll_data: Optional[dict]):
+    """Объявить победившие карты игры"""
+    state = await state_store.get(chat_id)
+    # Игру уже объявили или отменили
+    if not poll_data or state.polls.get(poll_data['map_poll_key']) is not poll_data:
+        return
+    num_maps = poll_data['num_maps']
+
+    try:
+        # Голоса уже подсчитаны по обновлениям опроса, порядок готов
+        tally = poll_data['tally']
+        ranked_maps = tally.ranked_options()
+        polled_maps = {map_id for map_id in tally.options if map_id != RANDOM_MAP_ID}
+        options, counts = tally.options, tally.counts
 
         # Выбираем победителей
         winners = []
-        polled_maps = [option.text for option in map_poll.options if option.text != RANDOM_OPTION]
 
-        for map_name, _ in map_votes:
+        for map_id in ranked_maps:
             if len(winners) >= num_maps:
                 break
 
-            if map_name == RANDOM_OPTION:
+            if map_id == RANDOM_MAP_ID:
                 # Выбираем случайную карту, которой нет в опросе и не в кд
-                random_map = get_random_map_not_in_list(polled_maps)
+                random_map = get_random_map_not_in_list(state.pool, polled_maps)
                 winners.append(random_map)
                 # Добавляем выбранную случайную карту в список, чтобы не выбирать её снова
-                polled_maps.append(random_map)
-            elif map_name not in winners:
-                winners.append(map_name)
-
-        # Обновляем статистику
-        for winner in winners:
-            map_wins_count[winner] += 1
-
-        # Добавляем в историю для кд
-        voting_history.extend(winners)
+                polled_maps.add(random_map)
+            elif map_id not in winners:
+                winners.append(map_id)
+
+        # Обновляем статистику и добавляем в историю для кд
+        state.record_winners(winners)
+        vote_log.append({
+            'chat': chat_id,
+            'time': datetime.now(TIMEZONE).isoformat(timespec='seconds'),
+            'options': [option_label(map_id) for map_id in options],
+            'counts': counts,
+            'winners': [map_registry.labels[map_id] for map_id in winners],
+        })
+
+        # Удаляем информацию об опросе до отправки, чтобы не объявить его дважды
+        del state.polls[poll_data['map_poll_key']]
+        unindex_poll(poll_data)
+        state_store.mark_dirty(chat_id)
 
         # Формируем сообщение с результатами
-        winner_text = "\n".join([f"• {map_name}" for map_name in winners])
+        winner_text = "\n".join([f"• {map_registry.titles[map_id]}" for map_id in winners])
         message = (
             f"🏆В голосовании победили карты:🏆\n\n"
             f"{winner_text}\n\n"
             f"Удачной игры!🎮"
         )
 
-        await context.bot.send_message(chat_id=chat_id, text=message)
-
-        # Удаляем информацию об опросе
-        if chat_id in active_polls:
-            del active_polls[chat_id]
+        await bot.send_message(chat_id=chat_id, text=message, rate_limit_args=PRIORITY_ANNOUNCE)
+        await stop_poll_message(bot, chat_id, poll_data['map_poll_id'])
 
     except Exception as e:
         logger.error(f"Error announcing winners: {e}")
-        await context.bot.send_message(
+        await bot.send_message(
             chat_id=chat_id,
-            text="Произошла ошибка при подсчете результатов"
+            text="Произошла ошибка при подсчете результатов",
+            rate_limit_args=PRIORITY_ERROR
         )
 
 
+async def stop_poll_message(bot: Bot, chat_id: int, message_id: int):
+    """Закрыть опрос, результаты которого уже не нужны"""
+    try:
+        await bot.stop_poll(chat_id, message_id)
+    except TelegramError as e:
+        logger.warning(f"Could not stop poll {message_id} in chat {chat_id}: {e}")
+
+
+async def cancel_poll(context: ContextTypes.DEFAULT_TYPE, state: ChatState, poll_data: dict):
+    """Отменить игру: убрать её из состояния и расписания и закрыть опросы"""
+    del state.polls[poll_data['map_poll_key']]
+    unindex_poll(poll_data)
+    remove_announcement_jobs(context.job_queue, state.chat_id, poll_data['map_poll_key'])
+    state_store.mark_dirty(state.chat_id)
+
+    await stop_poll_message(context.bot, state.chat_id, poll_data['registration_poll_id'])
+    await stop_poll_message(context.bot, state.chat_id, poll_data['map_poll_id'])
+
+
+@timed_handler("handle_poll")
+async def handle_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновить текущие голоса опроса карт"""
+    poll = update.poll
+    entry = poll_chats.get(poll.id)
+    if entry is None:
+        return
+
+    chat_id, poll_key = entry
+    state = await state_store.get(chat_id)
+    poll_data = state.polls.get(poll_key)
+    if not poll_data or poll_data['map_poll_key'] != poll.id:
+        return
+
+    poll_data['tally'].update([option.voter_count for option in poll.options], poll.total_voter_count)
+    state_store.mark_dirty(chat_id)
+
+    await close_poll_early(context, state, poll_data)
+
+
+@timed_handler("handle_poll_answer")
+async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Учесть ответ в опросе регистрации"""
+    answer = update.poll_answer
+    entry = poll_chats.get(answer.poll_id)
+    if entry is None:
+        return
+
+    chat_id, poll_key = entry
+    state = await state_store.get(chat_id)
+    poll_data = state.polls.get(poll_key)
+    if not poll_data or poll_data['registration_poll_key'] != answer.poll_id:
+        return
+
+    voter_id = answer.user.id if answer.user else answer.voter_chat.id
+    # Вариант 0 - "+", отзыв голоса приходит с пустым option_ids
+    if 0 in answer.option_ids:
+        poll_data['registered'].add(voter_id)
+    else:
+        poll_data['registered'].discard(voter_id)
+    state_store.mark_dirty(chat_id)
+
+    await close_poll_early(context, state, poll_data)
+
+
+async def close_poll_early(context: ContextTypes.DEFAULT_TYPE, state: ChatState, poll_data: dict):
+    """Объявить результаты сразу, если все записавшиеся игроки уже проголосовали"""
+    registered = len(poll_data['registered'])
+    if EARLY_CLOSE_PLAYERS <= 0 or registered < EARLY_CLOSE_PLAYERS:
+        return
+    if poll_data['tally'].voters < registered:
+        return
+
+    remove_announcement_jobs(context.job_queue, state.chat_id, poll_data['map_poll_key'])
+    await announce_poll(context.bot, state.chat_id, poll_data)
+
+
+@timed_handler("start_command")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     await update.message.reply_text(
@@ -340,83 +1022,446 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Пример: {BOT_TAG} 16:00 2\n\n"
         "В голосовании за карты всегда доступна опция '🎲 Случайная карта не из этого списка' "
         "для выбора случайной карты, которой нет в предложенных вариантах.\n\n"
+        "В чате можно назначить несколько игр на разное время, повторная команда на то же время "
+        "переназначает игру, а /cancel HH:MM отменяет её\n\n"
         "Команда /list выведет текущий набор карт в пуле\n"
+        "Команда /export [csv|jsonl] пришлёт файл с историей голосований чата\n"
         "Команда /status покажет статус бота: количество карт в пуле, число активных голосований, "
         "последние победившие карты и самые популярные карты"
     )
 
 
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Разбить текст на части не длиннее limit, по возможности по строкам"""
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        # Строку длиннее лимита режем как есть
+        while len(line) > limit:
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+
+        if size + len(line) > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def render_status_stats(state: ChatState) -> str:
+    """Последние победители и топ побед - меняются только при объявлении результатов"""
+    parts = []
+
+    recent_winners = state.pool.history
+    if recent_winners:
+        parts.append("Последние победившие карты:\n")
+        parts.extend(f"{i}. {map_registry.titles[map_id]}\n" for i, map_id in enumerate(recent_winners, 1))
+        parts.append("\n")
+
+    if state.wins:
+        parts.append("Топ побед карт:\n")
+        parts.extend(
+            f"{i}. {map_registry.labels[map_id]}: {wins} побед\n"
+            for i, (map_id, wins) in enumerate(state.leaderboard.top(10), 1)
+        )
+
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def render_map_list(pool: MapPool) -> List[str]:
+    """Текст /list для пула, уже разбитый на сообщения"""
+    parts = [f"🗺️ Всего карт: {len(pool)}\n\n"]
+
+    # Разбиваем на группы по 10 для лучшей читаемости
+    for i, map_id in enumerate(pool.registry.active, 1):
+        parts.append(f"{i}. {pool.registry.titles[map_id]}\n")
+
+        # Добавляем разделитель каждые 10 карт
+        if i % 10 == 0 and i != len(pool):
+            parts.append("\n")
+
+    return split_message("".join(parts))
+
+
+@timed_handler("status_command")
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статус бота и статистику"""
+    state = await state_store.get(update.message.chat_id)
+    expire_polls(state)
+
+    parts = [
+        f"🤖 Статус {BOT_NAME}:\n\n",
+        f"Всего карт в пуле: {len(state.pool)}\n",
+        f"Карт в кд: {len(state.pool.history)}\n",
+        f"Активных голосований: {len(state.polls)}\n\n",
+    ]
+
+    # Текущие лидеры меняются с каждым голосом, их не кешируем
+    for poll_data in sorted(state.polls.values(), key=lambda poll_data: poll_data['scheduled_time']):
+        tally = poll_data['tally']
+        parts.append(
+            f"Голосование на {poll_data['scheduled_time'].strftime('%H:%M')}: "
+            f"проголосовали {tally.voters}, записались {len(poll_data['registered'])}\n"
+        )
+        parts.extend(
+            f"• {option_label(tally.options[option])}: {tally.counts[option]}\n"
+            for option in tally.ranking[:poll_data['num_maps']]
+        )
+        parts.append("\n")
 
-    stats_text = f"🤖 Статус {BOT_NAME}:\n\n"
-    stats_text += f"Всего карт в пуле: {len(ALL_MAPS)}\n"
-    stats_text += f"Карт в кд: {len(voting_history)}\n"
-    stats_text += f"Активных голосований: {len(active_polls)}\n\n"
+    if state.status_cache is None:
+        state.status_cache = render_status_stats(state)
+    parts.append(state.status_cache)
 
-    if voting_history:
-        stats_text += "Последние победившие карты:\n"
-        for i, map_name in enumerate(voting_history, 1):
-            stats_text += f"{i}. {map_name}\n"
-        stats_text += "\n"
+    for chunk in split_message("".join(parts)):
+        await update.message.reply_text(chunk)
 
-    if map_wins_count:
-        stats_text += "Топ побед карт:\n"
-        sorted_wins = sorted(map_wins_count.items(), key=lambda x: -x[1])[:10]
-        for i, (map_name, wins) in enumerate(sorted_wins, 1):
-            # Укорачиваем длинные названия для лучшей читаемости
-            display_name = map_name.split(' - ')[0] if ' - ' in map_name else map_name[:20]
-            stats_text += f"{i}. {display_name}: {wins} побед\n"
 
-    await update.message.reply_text(stats_text)
+@timed_handler("cancel_command")
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменить игру: /cancel HH:MM, без времени - единственную запланированную"""
+    state = await state_store.get(update.message.chat_id)
+    async with state.lock:
+        expire_polls(state)
+        polls = sorted(state.polls.values(), key=lambda poll_data: poll_data['scheduled_time'])
+        if not polls:
+            await update.message.reply_text("Нет запланированных игр")
+            return
 
+        if context.args:
+            # Время можно указать без ведущего нуля: 9:30
+            match = TIME_RE.fullmatch(context.args[0])
+            time_str = f"{int(match[1]):02d}:{int(match[2]):02d}" if match else context.args[0]
+            polls = [poll_data for poll_data in polls if poll_data['scheduled_time'].strftime('%H:%M') == time_str]
+            if not polls:
+                await update.message.reply_text(f"Игры в {time_str} нет")
+                return
+        elif len(polls) > 1:
+            times = ", ".join(poll_data['scheduled_time'].strftime('%H:%M') for poll_data in polls)
+            await update.message.reply_text(f"Запланировано несколько игр ({times}), укажите время: /cancel HH:MM")
+            return
 
-async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать список всех карт"""
-    maps_text = f"🗺️ Всего карт: {len(ALL_MAPS)}\n\n"
+        poll_data = polls[0]
+        await cancel_poll(context, state, poll_data)
+    await update.message.reply_text(f"Игра в {poll_data['scheduled_time'].strftime('%H:%M')} отменена")
 
-    # Разбиваем на группы по 10 для лучшей читаемости
-    for i, map_name in enumerate(ALL_MAPS, 1):
-        maps_text += f"{i}. {map_name}\n"
 
-        # Добавляем разделитель каждые 10 карт
-        if i % 10 == 0 and i != len(ALL_MAPS):
-            maps_text += "\n"
+@timed_handler("export_command")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузить историю голосований чата файлом: /export [csv|jsonl]"""
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Формат выгрузки: /export csv или /export jsonl")
+        return
+    if not vote_log.enabled:
+        await update.message.reply_text("История голосований не ведётся")
+        return
 
-    await update.message.reply_text(maps_text)
+    chat_id = update.message.chat_id
+    # Свежие записи ещё могут быть в памяти
+    await vote_log.flush()
+    path = await asyncio.to_thread(vote_log.export, chat_id, fmt)
+    if path is None:
+        await update.message.reply_text("История голосований пока пуста")
+        return
+
+    try:
+        with open(path, "rb") as document:
+            await update.message.reply_document(document, filename=f"votes_{chat_id}.{fmt}")
+    finally:
+        os.remove(path)
+
+
+@timed_handler("list_command")
+async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать список всех карт"""
+    for chunk in render_map_list(map_pool):
+        await update.message.reply_text(chunk)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
+    if isinstance(context.error, ChatQueueFull):
+        # Чат и так засыпан ответами, сообщение об ошибке тоже не встанет в очередь
+        logger.warning(f"Dropped reply: {context.error}")
+        return
+
     logger.error(f"Exception while handling an update: {context.error}")
 
     if update and update.effective_chat:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="Произошла ошибка при обработке команды"
+            text="Произошла ошибка при обработке команды",
+            rate_limit_args=PRIORITY_ERROR
         )
 
 
-def main():
-    """Запуск бота"""
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+async def flush_state(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сбрасывать изменённые состояния чатов и журнал голосований на диск"""
+    await state_store.flush()
+    await vote_log.flush()
+
+
+async def compact_vote_log(context: ContextTypes.DEFAULT_TYPE):
+    """Сжать закрытые сегменты журнала голосований"""
+    await vote_log.compact()
+
+
+async def catch_up_announcements(context: ContextTypes.DEFAULT_TYPE):
+    """Объявить просроченные за время простоя результаты с ограниченным параллелизмом"""
+    queue = asyncio.Queue()
+    for chat_id, poll_data in context.job.data:
+        queue.put_nowait((chat_id, poll_data))
+
+    async def worker():
+        while not queue.empty():
+            chat_id, poll_data = queue.get_nowait()
+            observe_announcement_lag(poll_data)
+            await announce_poll(context.bot, chat_id, poll_data)
+
+    await asyncio.gather(*(worker() for _ in range(min(CATCHUP_CONCURRENCY, queue.qsize()))))
+
+
+async def fetch_backlog(bot: Bot) -> List[Update]:
+    """Забрать накопившиеся за простой обновления пачками и подтвердить их
+
+    При ошибке Telegram возвращаются только подтверждённые обновления,
+    остальные заберёт updater в обычном порядке.
+    """
+    if BACKLOG_LIMIT <= 0:
+        return []
+
+    updates = []
+    confirmed = 0  # сколько обновлений подтверждено запросом со следующим offset
+    offset = None
+    try:
+        # Пока установлен webhook, getUpdates недоступен; run_webhook установит его заново,
+        # а updater удаляет его только после post_init
+        await bot.delete_webhook()
+        while True:
+            batch = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=ALLOWED_UPDATES)
+            confirmed = len(updates)
+            if batch:
+                updates.extend(batch)
+                offset = batch[-1].update_id + 1
+            if not batch or len(updates) >= BACKLOG_LIMIT:
+                break
+
+        if batch:
+            # Запрос со следующим offset подтверждает последнюю пачку, остальное заберёт updater
+            await bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=ALLOWED_UPDATES)
+            confirmed = len(updates)
+    except TelegramError as e:
+        logger.error(f"Error fetching update backlog, leaving the rest to the updater: {e}")
+    return updates[:confirmed]
+
+
+def collapse_backlog(updates: List[Update]) -> Tuple[List[Update], Dict[int, List[Update]]]:
+    """Свернуть накопившиеся обновления: (обновления опросов, сообщения по чатам)
+
+    Из опросов остаётся последнее состояние каждого опроса и последний ответ
+    каждого игрока. Из команд через упоминание в чате остаётся последняя
+    выполнимая на каждое время игры, команды на прошедшее время и с ошибками отбрасываются без
+    ответа. Из остальных сообщений - последнее с каждой командой.
+    """
+    polls = {}  # id опроса: обновление
+    answers = {}  # (id опроса, id игрока): обновление
+    messages = defaultdict(dict)  # chat_id: ключ сообщения: обновление
+    now = datetime.now(TIMEZONE)
+
+    for update in updates:
+        if update.poll:
+            polls[update.poll.id] = update
+        elif update.poll_answer:
+            answer = update.poll_answer
+            voter_id = answer.user.id if answer.user else answer.voter_chat.id
+            answers[(answer.poll_id, voter_id)] = update
+        elif update.message and update.message.text:
+            message = update.message
+            mentioned, command = mention_filter.command(message)
+            if mentioned:
+                if command is None or not 1 <= command[1] <= 12 or game_datetime(command[0]) <= now:
+                    continue
+                key = command[0]  # новая команда на то же время заменяет предыдущую
+            else:
+                key = message.text.split()[0]
+            messages[message.chat_id][key] = update
+
+    poll_updates = sorted(list(polls.values()) + list(answers.values()), key=lambda update: update.update_id)
+    chat_updates = {
+        chat_id: sorted(chat_messages.values(), key=lambda update: update.update_id)
+        for chat_id, chat_messages in messages.items()
+    }
+
+    kept = len(poll_updates) + sum(len(chat_messages) for chat_messages in chat_updates.values())
+
+    metrics.BACKLOG_UPDATES.inc(kept, result="kept")
+    metrics.BACKLOG_UPDATES.inc(len(updates) - kept, result="dropped")
+    return poll_updates, chat_updates
+
+
+async def process_backlog(context: ContextTypes.DEFAULT_TYPE):
+    """Обработать свёрнутый бэклог в фоне: сначала голоса, затем чаты с ограниченным параллелизмом
+
+    Просроченные за простой игры объявляются только после голосов из
+    бэклога, иначе они были бы решены по подсчёту, сохранённому до простоя.
+    """
+    application = context.application
+    poll_updates, chat_updates, overdue = context.job.data
+
+    for update in poll_updates:
+        await application.process_update(update)
+    if overdue:
+        context.job_queue.run_once(catch_up_announcements, 0, data=overdue)
+
+    queue = asyncio.Queue()
+    for updates in chat_updates.values():
+        queue.put_nowait(updates)
+
+    async def worker():
+        # Сообщения одного чата обрабатываются по порядку
+        while not queue.empty():
+            for update in queue.get_nowait():
+                await application.process_update(update)
+
+    await asyncio.gather(*(worker() for _ in range(min(CATCHUP_CONCURRENCY, queue.qsize()))))
+    logger.info(f"Processed backlog: {len(poll_updates)} poll updates, {len(chat_updates)} chats")
+
+
+async def post_init(application: Application):
+    """Поднять метрики, восстановить объявления и разобрать обновления, пришедшие за время простоя"""
+    global metrics_server
+    mention_filter.username = application.bot.username.lower()
+
+    if METRICS_PORT:
+        metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+    states = await state_store.load_pending(shard)
+    current_time = datetime.now(TIMEZONE)
+
+    scheduled = 0
+    overdue = []  # (chat_id, данные игры)
+    for state in states:
+        expire_polls(state)
+        for poll_data in state.polls.values():
+            index_poll(state.chat_id, poll_data)
+            if poll_data['scheduled_time'] - ANNOUNCE_BEFORE > current_time:
+                await schedule_map_announcement(application.job_queue, state.chat_id, poll_data)
+                scheduled += 1
+            else:
+                overdue.append((state.chat_id, poll_data))
+
+    logger.info(f"Restored {scheduled} announcements, {len(overdue)} overdue")
+
+    if shard is not None:
+        # Воркерам бэклог раздаёт приёмник shards.py, просроченные игры ждут его
+        overdue_polls.extend(overdue)
+        return
+
+    backlog = await fetch_backlog(application.bot)
+    poll_updates, chat_updates = collapse_backlog(backlog) if backlog else ([], {})
+    if poll_updates or chat_updates or overdue:
+        application.job_queue.run_once(process_backlog, 0, data=(poll_updates, chat_updates, overdue))
+
+
+async def post_shutdown(application: Application):
+    """Сохранить несброшенные изменения при остановке"""
+    await state_store.close()
+    await vote_log.flush()
+
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+
+def configure():
+    """Подключить хранилище и реестр карт согласно конфигурации"""
+    global state_store, map_registry, map_pool, vote_log
+    state_store = create_state_store()
+    # У каждого воркера свои сегменты журнала в общем каталоге
+    vote_log = VoteLog(
+        VOTE_LOG_DIR or None,
+        f"votes-{shard[0]}" if shard else "votes",
+        VOTE_LOG_SEGMENT_BYTES,
+        VOTE_LOG_RETENTION_DAYS
+    )
+    # id карт берутся из хранилища, чтобы сохранённые состояния пережили правку ALL_MAPS
+    labels = [MapRegistry.label_of(title) for title in ALL_MAPS]
+    map_registry = MapRegistry(ALL_MAPS, state_store.backend.map_ids(labels))
+    map_pool = MapPool(map_registry)
+    metrics.slow_call_threshold = SLOW_CALL_SECONDS
+
+
+def build_application(updater: bool = True) -> Application:
+    """Собрать приложение с обработчиками; без updater обновления подаются в update_queue извне"""
+    # Общий лимит Telegram на бота делится между воркерами поровну
+    global_rate = GLOBAL_RATE / shard[1] if shard else GLOBAL_RATE
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(PriorityRateLimiter(global_rate=global_rate))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("list", list_command))
-    application.add_handler(MessageHandler(
-        filters.TEXT & filters.Entity("mention"),
-        handle_mention
-    ))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(MessageHandler(mention_filter, handle_mention))
+    application.add_handler(PollHandler(handle_poll))
+    application.add_handler(PollAnswerHandler(handle_poll_answer))
 
     # Регистрируем обработчик ошибок
     application.add_error_handler(error_handler)
 
+    # Отложенная запись состояния чатов
+    application.job_queue.run_repeating(flush_state, STATE_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(compact_vote_log, VOTE_LOG_COMPACT_INTERVAL)
+
+    return application
+
+
+def run_application(application: Application):
+    """Получать обновления через webhook, если он задан, иначе long polling"""
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+def main():
+    """Запуск бота"""
+    configure()
+    application = build_application()
+
     # Запускаем бота
     print(f"{BOT_NAME} запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(application)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Порог медленного вызова в секундах, 0 - не логировать
+slow_call_threshold = 0.0
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Метрика с набором меток, значения хранятся по кортежу значений меток"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, value in self._values.items():
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: Tuple[str, ...], value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Считать значение при каждом опросе, а не хранить его"""
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            self._values[()] = self._function()
+        return super().render()
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # Счётчики по корзинам (последняя - +Inf) и сумма
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def _render_value(self, key: Tuple[str, ...], value) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+HANDLER_LATENCY = Histogram(
+    "matchmaker_handler_seconds", "Время обработки обновления", ("handler",)
+)
+MENTION_COMMANDS = Counter(
+    "matchmaker_mention_commands_total", "Команды через упоминание бота по результату", ("result",)
+)
+MENTION_FILTER = Counter(
+    "matchmaker_mention_filter_total", "Сообщения с упоминаниями, отсеянные или пропущенные фильтром", ("result",)
+)
+BACKLOG_UPDATES = Counter(
+    "matchmaker_backlog_updates_total", "Обновления, накопившиеся за время простоя, по результату свёртки", ("result",)
+)
+API_LATENCY = Histogram(
+    "matchmaker_api_call_seconds", "Время вызовов Bot API", ("method",)
+)
+OUTBOUND_WAIT = Histogram(
+    "matchmaker_outbound_wait_seconds", "Ожидание вызова Bot API в очереди ограничителя", ("method",)
+)
+OUTBOUND_DROPPED = Counter(
+    "matchmaker_outbound_dropped_total", "Запросы, отброшенные из-за переполненной очереди чата", ("method",)
+)
+API_ERRORS = Counter(
+    "matchmaker_api_errors_total", "Ошибки вызовов Bot API", ("method", "error")
+)
+ANNOUNCEMENT_LAG = Gauge(
+    "matchmaker_announcement_lag_seconds", "Опоздание последнего объявления относительно расписания"
+)
+ACTIVE_POLLS = Gauge(
+    "matchmaker_active_polls", "Активных голосований в этом процессе"
+)
+
+
+def log_if_slow(kind: str, name: str, elapsed: float):
+    if slow_call_threshold and elapsed >= slow_call_threshold:
+        logger.warning(f"Slow {kind} {name}: {elapsed:.3f}s")
+
+
+def timed_handler(name: str):
+    """Декоратор: замерять время асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                HANDLER_LATENCY.observe(elapsed, handler=name)
+                log_if_slow("handler", name, elapsed)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, дочитываем до пустой строки
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Поднять HTTP-эндпоинт /metrics в формате Prometheus"""
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
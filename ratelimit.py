@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньше - важнее
+PRIORITY_ANNOUNCE = 0  # объявление победителей
+PRIORITY_DEFAULT = 1  # опросы и ответы на команды
+PRIORITY_ERROR = 2  # сообщения об ошибках
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~20 в минуту на группу,
+# в личном чате не чаще раза в секунду
+GLOBAL_RATE = 30.0
+GROUP_RATE = 20 / 60
+GROUP_BURST = 5
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 1
+# Сколько запросов может ждать в очереди одного чата. Ждущий запрос занимает
+# слот обработки обновлений, поэтому без предела один чат, засыпающий бота
+# командами, занял бы все слоты. Объявления принимаются всегда.
+CHAT_QUEUE_LIMIT = 10
+
+
+class ChatQueueFull(TelegramError):
+    """Очередь чата переполнена, запрос отброшен без отправки"""
+
+
+class TokenBucket:
+    """Ведро токенов с блокировкой до момента, указанного в RetryAfter"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен, 0 - уже доступен"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def is_idle(self, now: float) -> bool:
+        """Ведро полное и не заблокировано - его можно забыть"""
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Ограничитель исходящих запросов с приоритетами и лимитами на чат
+
+    Каждый запрос с chat_id ждёт токен в ведре своего чата и в общем ведре.
+    Из готовых к отправке чатов первым уходит запрос с наименьшим приоритетом
+    (rate_limit_args), а при равенстве - пришедший раньше. RetryAfter
+    блокирует ведро чата (или общее, если чата нет), поэтому все ждущие
+    запросы этого чата повторяются вместе после одной паузы. Если в очереди
+    чата уже CHAT_QUEUE_LIMIT запросов, новые запросы кроме объявлений сразу
+    завершаются ChatQueueFull.
+    """
+
+    def __init__(self, max_retries: int = 3, global_rate: float = GLOBAL_RATE,
+                 chat_queue_limit: int = CHAT_QUEUE_LIMIT):
+        self.max_retries = max_retries
+        self.chat_queue_limit = chat_queue_limit
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets: Dict[int, TokenBucket] = {}  # chat_id: ведро
+        self._queues: Dict[int, List[Tuple[int, int, asyncio.Future]]] = {}  # chat_id: куча запросов
+        self._ready: List[Tuple[int, int, int]] = []  # (приоритет, номер, chat_id) чатов с токеном
+        self._sleeping: List[Tuple[float, int]] = []  # (когда будет токен, chat_id)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+        for queue in self._queues.values():
+            for _, _, future in queue:
+                future.cancel()
+        self._queues.clear()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        chat_id = data.get('chat_id')
+        priority = PRIORITY_DEFAULT if rate_limit_args is None else rate_limit_args
+        # Повтор сохраняет исходный номер и не уходит в конец очереди чата
+        number = next(self._counter)
+
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            if isinstance(chat_id, int):
+                if priority > PRIORITY_ANNOUNCE and len(self._queues.get(chat_id, ())) >= self.chat_queue_limit:
+                    metrics.OUTBOUND_DROPPED.inc(method=endpoint)
+                    raise ChatQueueFull(f"Too many pending requests in chat {chat_id}")
+                await self._acquire(chat_id, priority, number)
+            else:
+                # Служебные запросы без чата (getMe, setWebhook) ждут только общей паузы
+                await self._wait_global_block()
+
+            metrics.OUTBOUND_WAIT.observe(time.perf_counter() - queued, method=endpoint)
+            try:
+                return await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+                logger.warning(f"{endpoint} hit flood control in chat {chat_id}, retrying in {seconds}s")
+
+                until = time.monotonic() + seconds + 0.1
+                if isinstance(chat_id, int):
+                    self._bucket(chat_id).block(until)
+                else:
+                    self._global.block(until)
+
+    @staticmethod
+    async def _call(callback, args: Any, kwargs: Dict[str, Any], endpoint: str) -> Any:
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            metrics.API_ERRORS.inc(method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.API_LATENCY.observe(elapsed, method=endpoint)
+            metrics.log_if_slow("API call", endpoint, elapsed)
+
+    async def _wait_global_block(self):
+        delay = self._global.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id у групп и каналов, положительные - личные чаты
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: int, priority: int, number: int):
+        """Встать в очередь чата и дождаться своей очереди на отправку"""
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, number, future)
+
+        queue = self._queues.setdefault(chat_id, [])
+        heapq.heappush(queue, entry)
+        if queue[0] is entry:
+            # Запрос стал первым в чате - чат участвует в выборе с новым приоритетом
+            heapq.heappush(self._ready, (entry[0], entry[1], chat_id))
+            self._wakeup.set()
+
+        await future
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+
+            # Чаты, у которых появился токен, снова готовы к отправке
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self._sleeping)
+                self._push_ready(chat_id)
+
+            if not self._ready:
+                if not self._sleeping:
+                    self._forget_idle_buckets(now)
+                timeout = self._sleeping[0][0] - now if self._sleeping else None
+                await self._wait(timeout)
+                continue
+
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            priority, number, chat_id = heapq.heappop(self._ready)
+            queue = self._queues.get(chat_id)
+            if not queue or (queue[0][0], queue[0][1]) != (priority, number):
+                # Устаревшая запись: голова очереди чата уже сменилась
+                continue
+
+            bucket = self._bucket(chat_id)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                heapq.heappush(self._sleeping, (now + chat_delay, chat_id))
+                continue
+
+            _, _, future = heapq.heappop(queue)
+            if not future.done():
+                bucket.take(now)
+                self._global.take(now)
+                future.set_result(None)
+
+            if queue:
+                self._push_ready(chat_id)
+            else:
+                del self._queues[chat_id]
+
+    def _forget_idle_buckets(self, now: float):
+        # Полные ведра ничем не отличаются от новых, не держим их для тысяч чатов
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items() if bucket.is_idle(now)]:
+            del self._buckets[chat_id]
+
+    def _push_ready(self, chat_id: int):
+        queue = self._queues.get(chat_id)
+        if queue:
+            heapq.heappush(self._ready, (queue[0][0], queue[0][1], chat_id))
+
+    async def _wait(self, timeout: Optional[float]):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
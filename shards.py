@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import List
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+import main as bot
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+# Сколько обновлений ждёт отправки одному воркеру, прежде чем новые начнут отбрасываться
+WORKER_QUEUE_LIMIT = int(os.environ.get("WORKER_QUEUE_LIMIT", "10000"))
+
+WORKER_CHECK_INTERVAL = 5  # секунд между проверками живости воркеров
+WORKER_MIN_UPTIME = 60  # воркер, упавший быстрее, не перезапускается - бот останавливается
+
+
+def shard_of(chat_id: int, count: int) -> int:
+    """Номер воркера, которому принадлежит чат"""
+    return chat_id % count
+
+
+class Worker:
+    """Процесс-воркер и поток, который пишет ему в канал
+
+    Запись в канал блокируется, пока воркер не разгребёт его, поэтому
+    приёмник только кладёт обновление в очередь, а пишет отдельный поток.
+    Обновления, отправленные упавшему воркеру, теряются.
+    """
+
+    def __init__(self, context, index: int, count: int):
+        self.context = context
+        self.index = index
+        self.count = count
+        self.queue = queue.Queue(WORKER_QUEUE_LIMIT)
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.start()
+        self.thread = threading.Thread(target=self._write, name=f"writer-{index}", daemon=True)
+        self.thread.start()
+
+    def start(self):
+        """Запустить процесс воркера с новым каналом"""
+        reader, writer = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(
+            target=run_worker, args=(self.index, self.count, reader), name=f"worker-{self.index}"
+        )
+        self.process.start()
+        reader.close()
+        old, self.conn = self.conn, writer
+        if old is not None:
+            old.close()
+        self.started = time.monotonic()
+
+    def send(self, data: bytes):
+        """Поставить обновление в очередь на отправку, не блокируя приёмник"""
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            logger.warning(f"Worker {self.index} is not keeping up, update dropped")
+
+    def send_backlog(self, polls: List[dict], chats: List[list], kept: int = 0, dropped: int = 0):
+        """Отправить часть бэклога; воркер ждёт её, прежде чем объявлять просроченные игры
+
+        kept и dropped - доля воркера в счётчике свёрнутых обновлений: у приёмника
+        метрик нет, поэтому их показывает воркер.
+        """
+        backlog = {'polls': polls, 'chats': chats, 'kept': kept, 'dropped': dropped}
+        self.send(json.dumps({'backlog': backlog}).encode())
+
+    def _write(self):
+        while (data := self.queue.get()) is not None:
+            try:
+                self.conn.send_bytes(data)
+            except OSError as e:
+                # Воркер упал, его перезапустит проверка живости
+                logger.error(f"Error sending update to worker {self.index}: {e}")
+
+    def close(self):
+        """Отправить оставшиеся обновления, закрыть канал и дождаться воркера"""
+        self.queue.put(None)
+        self.thread.join()
+        self.conn.close()
+        self.process.join()
+
+
+def build_ingress(workers: List[Worker]) -> Application:
+    """Приложение-приёмник: только получает обновления и раздаёт их воркерам"""
+
+    def send(update: Update):
+        data = json.dumps(update.to_dict()).encode()
+        chat = update.effective_chat
+        if chat is None:
+            # В обновлениях опросов нет чата, чужие опросы воркер отбросит по poll_chats
+            for worker in workers:
+                worker.send(data)
+        else:
+            workers[shard_of(chat.id, len(workers))].send(data)
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        send(update)
+
+    async def post_init(application: Application):
+        # Бэклог за простой сворачивается здесь, а разбирает его воркер в фоне через process_backlog
+        bot.mention_filter.username = application.bot.username.lower()
+        backlog = await bot.fetch_backlog(application.bot)
+        poll_updates, chat_updates = bot.collapse_backlog(backlog)
+        polls = [update.to_dict() for update in poll_updates]
+        chats = [[] for _ in workers]  # по воркерам: пары [chat_id, обновления чата]
+        kept = [0] * len(workers)
+        for chat_id, updates in chat_updates.items():
+            index = shard_of(chat_id, len(workers))
+            chats[index].append([chat_id, [update.to_dict() for update in updates]])
+            kept[index] += len(updates)
+        # Обновления опросов получают все воркеры, а в счётчик их записывает первый вместе с отброшенными
+        kept[0] += len(poll_updates)
+        dropped = len(backlog) - sum(kept)
+        # Пустая часть тоже отправляется: по ней воркер объявляет просроченные игры
+        for worker, worker_chats in zip(workers, chats):
+            worker.send_backlog(polls, worker_chats, kept[worker.index], dropped if worker.index == 0 else 0)
+
+    async def check_workers(context: ContextTypes.DEFAULT_TYPE):
+        """Перезапустить упавшего воркера, а если он падает сразу после старта - остановить бота"""
+        for worker in workers:
+            if worker.process.is_alive():
+                continue
+
+            if time.monotonic() - worker.started < WORKER_MIN_UPTIME:
+                logger.error(
+                    f"Worker {worker.index} exited with code {worker.process.exitcode} right after start, stopping"
+                )
+                context.application.stop_running()
+                return
+
+            logger.error(f"Worker {worker.index} exited with code {worker.process.exitcode}, restarting")
+            worker.start()
+            # Бэклог уже разобран, перезапущенному воркеру остаётся объявить просроченные игры
+            worker.send_backlog([], [])
+
+    # Обновления пересылаются по одному, чтобы сохранить их порядок внутри чата
+    builder = Application.builder().token(bot.BOT_TOKEN).concurrent_updates(False).post_init(post_init)
+    if bot.TELEGRAM_API_URL:
+        builder = builder.base_url(f"{bot.TELEGRAM_API_URL}/bot").base_file_url(f"{bot.TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, forward))
+    application.job_queue.run_repeating(check_workers, interval=WORKER_CHECK_INTERVAL, first=WORKER_CHECK_INTERVAL)
+    return application
+
+
+def run_worker(index: int, count: int, conn: Connection):
+    """Точка входа процесса-воркера: обычный бот для чатов своего шарда"""
+    # Воркер останавливается по закрытию канала приёмником, а не по Ctrl+C из терминала
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    bot.shard = (index, count)
+    if bot.METRICS_PORT:
+        bot.METRICS_PORT += index
+    bot.configure()
+    asyncio.run(serve_worker(bot.build_application(updater=False), conn))
+
+
+async def serve_worker(application: Application, conn: Connection):
+    """Передавать обновления из канала в приложение, пока приёмник не закроет канал"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def on_readable():
+        # Забираем всё, что уже пришло, не блокируя цикл событий
+        try:
+            while conn.poll():
+                queue.put_nowait(conn.recv_bytes())
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            queue.put_nowait(None)
+
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        loop.add_reader(conn.fileno(), on_readable)
+        try:
+            while (data := await queue.get()) is not None:
+                payload = json.loads(data)
+                if 'backlog' not in payload:
+                    await application.update_queue.put(Update.de_json(payload, application.bot))
+                    continue
+
+                # Свою часть бэклога воркер разбирает с ограниченным параллелизмом, не задерживая новые обновления
+                backlog = payload['backlog']
+                metrics.BACKLOG_UPDATES.inc(backlog['kept'], result="kept")
+                metrics.BACKLOG_UPDATES.inc(backlog['dropped'], result="dropped")
+                poll_updates = [Update.de_json(update, application.bot) for update in backlog['polls']]
+                chat_updates = {
+                    chat_id: [Update.de_json(update, application.bot) for update in updates]
+                    for chat_id, updates in backlog['chats']
+                }
+                overdue, bot.overdue_polls[:] = bot.overdue_polls[:], []
+                application.job_queue.run_once(bot.process_backlog, 0, data=(poll_updates, chat_updates, overdue))
+        finally:
+            await application.stop()
+            await application.post_shutdown(application)
+
+
+def main():
+    """Запуск бота несколькими процессами с разбиением чатов по chat_id
+
+    Приёмник получает обновления от Telegram (long polling или webhook) и
+    пересылает их воркерам по каналам multiprocessing: обновление с чатом -
+    воркеру chat_id % WORKERS, обновления опросов - всем. Каждый воркер
+    держит опросы, кд и объявления своих чатов. Воркеры пишут в одну базу
+    SQLite в режиме WAL и при старте поднимают только объявления своего
+    шарда, поэтому смена WORKERS при перезапуске перераспределяет чаты.
+    Метрики воркера доступны на METRICS_PORT + номер воркера. Упавший
+    воркер перезапускается; если он падает сразу после запуска, бот
+    останавливается целиком.
+    """
+    context = multiprocessing.get_context("spawn")
+    workers = [Worker(context, index, WORKERS) for index in range(WORKERS)]
+
+    print(f"{bot.BOT_NAME} запущен: {WORKERS} воркеров...")
+    try:
+        bot.run_application(build_ingress(workers))
+    finally:
+        for worker in workers:
+            worker.close()
+
+    # Остановились из-за упавшего воркера - сообщаем об этом кодом выхода
+    if any(worker.process.exitcode for worker in workers):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
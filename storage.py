@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """Бэкенд без диска: всё состояние живёт только в кеше StateStore"""
+
+    blocking = False  # вызовы мгновенные, поток для них не нужен
+
+    def load(self, chat_id: int) -> Optional[dict]:
+        return None
+
+    def load_pending(self, shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, dict]]:
+        return []
+
+    def map_ids(self, labels: List[str]) -> Dict[str, int]:
+        return {label: map_id for map_id, label in enumerate(labels)}
+
+    def write(self, batch: Dict[int, Tuple[str, Optional[float]]]):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Бэкенд на SQLite в режиме WAL, одна строка с JSON на чат
+
+    Рядом с состоянием хранится время ближайшего объявления результатов
+    (announce_at), чтобы после перезапуска поднять все ожидающие объявления
+    одним запросом по индексу. Таблица maps закрепляет за картами id,
+    которыми они записаны в состояниях чатов.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        # Соединение используется из потоков asyncio.to_thread, доступ под замком
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id INTEGER PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chats)")}
+        if 'announce_at' not in columns:
+            self._conn.execute("ALTER TABLE chats ADD COLUMN announce_at REAL")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chats_announce_at ON chats (announce_at) "
+            "WHERE announce_at IS NOT NULL"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS maps ("
+            "map_id INTEGER PRIMARY KEY, "
+            "label TEXT NOT NULL UNIQUE)"
+        )
+        self._conn.commit()
+
+    def load(self, chat_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        return self._decode(chat_id, row[0]) if row else None
+
+    def load_pending(self, shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, dict]]:
+        """Загрузить чаты с ожидающим объявлением одним запросом
+
+        shard - (номер, всего): только чаты, у которых chat_id % всего == номер.
+        """
+        query = "SELECT chat_id, state FROM chats WHERE announce_at IS NOT NULL"
+        params = ()
+        if shard is not None:
+            # В SQLite остаток от отрицательного числа отрицательный, приводим как в Python
+            index, count = shard
+            query += " AND ((chat_id % ?) + ?) % ? = ?"
+            params = (count, count, count, index)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY announce_at", params).fetchall()
+        # Строку, которую не удалось разобрать, пропускаем, а не роняем весь запуск
+        decoded = ((chat_id, self._decode(chat_id, state)) for chat_id, state in rows)
+        return [(chat_id, data) for chat_id, data in decoded if data is not None]
+
+    @staticmethod
+    def _decode(chat_id: int, state: str) -> Optional[dict]:
+        try:
+            return json.loads(state)
+        except ValueError as e:
+            logger.error(f"Cannot decode state of chat {chat_id}: {e}")
+            return None
+
+    def map_ids(self, labels: List[str]) -> Dict[str, int]:
+        """id карт по меткам: сохранённые остаются, новым выдаются следующие по порядку"""
+        with self._lock, self._conn:
+            ids = dict(self._conn.execute("SELECT label, map_id FROM maps"))
+            next_id = max(ids.values(), default=-1) + 1
+            for label in labels:
+                if label not in ids:
+                    ids[label] = next_id
+                    next_id += 1
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO maps (map_id, label) VALUES (?, ?)",
+                [(map_id, label) for label, map_id in ids.items()]
+            )
+        return ids
+
+    def write(self, batch: Dict[int, Tuple[str, Optional[float]]]):
+        """Записать пачку состояний одной транзакцией"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO chats (chat_id, state, updated_at, announce_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET "
+                "state = excluded.state, updated_at = excluded.updated_at, "
+                "announce_at = excluded.announce_at",
+                [
+                    (chat_id, state, now, announce_at)
+                    for chat_id, (state, announce_at) in batch.items()
+                ]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class StateStore:
+    """Кеш состояний чатов с отложенной пакетной записью в бэкенд
+
+    Чтение с диска и запись выполняются в отдельном потоке, поэтому цикл
+    событий на диске не блокируется. Изменённые чаты помечаются через
+    mark_dirty и сбрасываются одной транзакцией при вызове flush.
+
+    Состояние должно уметь to_dict() и announce_at() - время ближайшего
+    объявления в секундах epoch или None.
+    """
+
+    def __init__(self, backend, factory: Callable[[int, Optional[dict]], Any]):
+        self.backend = backend
+        self._factory = factory  # (chat_id, сохранённые данные или None) -> состояние
+        self._states = {}  # chat_id: состояние
+        self._loading = {}  # chat_id: задача загрузки
+        self._dirty: Set[int] = set()
+        self._flush_lock = asyncio.Lock()
+
+    async def get(self, chat_id: int):
+        """Получить состояние чата, при необходимости загрузив его"""
+        state = self._states.get(chat_id)
+        if state is not None:
+            return state
+
+        # Одновременные запросы одного чата ждут одну и ту же загрузку
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(chat_id))
+            self._loading[chat_id] = task
+        return await task
+
+    async def _load(self, chat_id: int):
+        try:
+            data = await self._call(self.backend.load, chat_id)
+            state = self._restore(chat_id, data)
+            self._states[chat_id] = state
+            return state
+        finally:
+            self._loading.pop(chat_id, None)
+
+    async def load_pending(self, shard: Optional[Tuple[int, int]] = None) -> list:
+        """Загрузить в кеш все чаты (или чаты шарда) с ожидающими объявлениями"""
+        rows = await self._call(self.backend.load_pending, shard)
+        states = []
+        for chat_id, data in rows:
+            # Уже загруженное состояние свежее того, что лежит на диске
+            state = self._states.get(chat_id)
+            if state is None:
+                state = self._restore(chat_id, data)
+                self._states[chat_id] = state
+            states.append(state)
+        return states
+
+    def _restore(self, chat_id: int, data: Optional[dict]):
+        """Собрать состояние из сохранённых данных, несовместимые данные сбросить"""
+        try:
+            return self._factory(chat_id, data)
+        except (KeyError, TypeError, ValueError, IndexError) as e:
+            # Например, строка старого формата: чат начинает с чистого состояния
+            logger.error(f"Cannot restore state of chat {chat_id}, resetting it: {e!r}")
+            self._dirty.add(chat_id)
+            return self._factory(chat_id, None)
+
+    async def _call(self, func, *args):
+        # Дисковые вызовы уходят в поток, мгновенные выполняются на месте
+        if self.backend.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def mark_dirty(self, chat_id: int):
+        self._dirty.add(chat_id)
+
+    async def flush(self):
+        """Сбросить изменённые чаты в бэкенд одной пачкой"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            dirty, self._dirty = self._dirty, set()
+            batch = {
+                chat_id: (
+                    json.dumps(self._states[chat_id].to_dict(), ensure_ascii=False),
+                    self._states[chat_id].announce_at()
+                )
+                for chat_id in dirty
+                if chat_id in self._states
+            }
+
+            try:
+                await self._call(self.backend.write, batch)
+            except Exception as e:
+                logger.error(f"Error flushing chat state: {e}")
+                # Вернём чаты в очередь, чтобы записать их при следующем сбросе
+                self._dirty |= dirty
+
+    async def close(self):
+        await self.flush()
+        self.backend.close()
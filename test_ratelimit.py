@@ -0,0 +1,144 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+import ratelimit
+from ratelimit import (
+    GROUP_BURST,
+    PRIORITY_ANNOUNCE,
+    PRIORITY_DEFAULT,
+    PRIORITY_ERROR,
+    ChatQueueFull,
+    PriorityRateLimiter,
+)
+
+GROUP = -100
+OTHER_GROUP = -200
+
+
+class Recorder:
+    """Колбэк запроса: запоминает порядок и время отправки"""
+
+    def __init__(self):
+        self.sent = []  # (метка, время отправки)
+        self.failures = {}  # метка: сколько раз ответить RetryAfter
+
+    def request(self, limiter: PriorityRateLimiter, label: str, chat_id: int, priority: int = None):
+        async def callback():
+            self.sent.append((label, time.monotonic()))
+            if self.failures.get(label):
+                self.failures[label] -= 1
+                raise RetryAfter(timedelta(seconds=0.2))
+            return label
+
+        return asyncio.ensure_future(
+            limiter.process_request(callback, (), {}, "sendMessage", {'chat_id': chat_id}, priority)
+        )
+
+    def labels(self):
+        return [label for label, _ in self.sent]
+
+
+async def with_limiter(body, **kwargs):
+    limiter = PriorityRateLimiter(**kwargs)
+    await limiter.initialize()
+    try:
+        return await body(limiter)
+    finally:
+        await limiter.shutdown()
+
+
+def test_requests_leave_in_priority_order():
+    async def body(limiter):
+        recorder = Recorder()
+        tasks = [
+            recorder.request(limiter, "error", GROUP, PRIORITY_ERROR),
+            recorder.request(limiter, "reply", GROUP, None),
+            recorder.request(limiter, "announce", GROUP, PRIORITY_ANNOUNCE),
+            recorder.request(limiter, "poll", GROUP, PRIORITY_DEFAULT),
+        ]
+        await asyncio.gather(*tasks)
+        return recorder.labels()
+
+    # При равных приоритетах раньше уходит пришедший раньше
+    assert asyncio.run(with_limiter(body)) == ["announce", "reply", "poll", "error"]
+
+
+def test_group_burst_then_paced(monkeypatch):
+    monkeypatch.setattr(ratelimit, "GROUP_RATE", 10.0)
+
+    async def body(limiter):
+        recorder = Recorder()
+        tasks = [recorder.request(limiter, str(i), GROUP) for i in range(GROUP_BURST + 2)]
+        await asyncio.sleep(0.05)
+        sent_in_burst = len(recorder.sent)
+        await asyncio.gather(*tasks)
+        return sent_in_burst, recorder
+
+    sent_in_burst, recorder = asyncio.run(with_limiter(body))
+    assert sent_in_burst == GROUP_BURST
+    assert recorder.labels() == [str(i) for i in range(GROUP_BURST + 2)]
+    # Сверх запаса запросы идут не чаще GROUP_RATE
+    times = [sent for _, sent in recorder.sent]
+    assert times[GROUP_BURST] - times[0] >= 0.09
+    assert times[GROUP_BURST + 1] - times[GROUP_BURST] >= 0.09
+
+
+def test_retry_after_blocks_only_that_chat():
+    async def body(limiter):
+        recorder = Recorder()
+        recorder.failures["first"] = 1
+        first = recorder.request(limiter, "first", GROUP)
+        await asyncio.sleep(0.02)
+        start = time.monotonic()
+        # Пока чат заблокирован, его запросы ждут, а другой чат отправляет сразу
+        second = recorder.request(limiter, "second", GROUP)
+        other = recorder.request(limiter, "other", OTHER_GROUP)
+        assert await first == "first"
+        await asyncio.gather(second, other)
+        return start, {label: sent for label, sent in recorder.sent}, recorder.labels()
+
+    start, sent, labels = asyncio.run(with_limiter(body))
+    assert labels == ["first", "other", "first", "second"]
+    assert sent["other"] - start < 0.1
+    # Блокировка 0.2 с из RetryAfter и запас 0.1 с, отсчитанные от первой попытки
+    assert sent["second"] - start >= 0.25
+    assert sent["first"] - start >= 0.25
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def body(limiter):
+        recorder = Recorder()
+        recorder.failures["doomed"] = 5
+        with pytest.raises(RetryAfter):
+            await recorder.request(limiter, "doomed", GROUP)
+        return recorder.labels()
+
+    assert asyncio.run(with_limiter(body, max_retries=1)) == ["doomed", "doomed"]
+
+
+def test_full_chat_queue_drops_all_but_announcements():
+    async def body(limiter):
+        recorder = Recorder()
+        # Запас чата уже потрачен, дальше запросы копятся в очереди
+        for i in range(GROUP_BURST):
+            await recorder.request(limiter, f"burst{i}", GROUP)
+        queued = [recorder.request(limiter, f"queued{i}", GROUP) for i in range(3)]
+        await asyncio.sleep(0)
+
+        with pytest.raises(ChatQueueFull):
+            await recorder.request(limiter, "reply", GROUP)
+        announce = recorder.request(limiter, "announce", GROUP, PRIORITY_ANNOUNCE)
+        # Другой чат ограничение очереди не затрагивает
+        assert await recorder.request(limiter, "other", OTHER_GROUP) == "other"
+
+        assert not announce.done()
+        for task in queued + [announce]:
+            task.cancel()
+        return recorder.labels()
+
+    labels = asyncio.run(with_limiter(body, chat_queue_limit=3))
+    assert "reply" not in labels
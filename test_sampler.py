@@ -0,0 +1,79 @@
+import random
+from collections import Counter
+
+from main import WeightedSampler
+
+# Веса попадают в разные корзины frexp и по нескольку в одну корзину
+WEIGHTS = {'a': 1.0, 'b': 1.5, 'c': 3.0, 'd': 8.0, 'e': 0.25, 'f': 20.0}
+
+
+def make_sampler() -> WeightedSampler:
+    sampler = WeightedSampler()
+    for item, weight in WEIGHTS.items():
+        sampler.set(item, weight)
+    return sampler
+
+
+def test_draw_frequencies_follow_weights():
+    random.seed(1)
+    sampler = make_sampler()
+    draws = 100000
+    counts = Counter(sampler.draw() for _ in range(draws))
+
+    total = sum(WEIGHTS.values())
+    for item, weight in WEIGHTS.items():
+        expected = draws * weight / total
+        assert abs(counts[item] - expected) < 0.05 * expected + 50, item
+
+
+def test_set_changes_weight_and_remove_drops_item():
+    random.seed(2)
+    sampler = make_sampler()
+    sampler.set('a', 20.0)
+    sampler.remove('f')
+
+    draws = 50000
+    counts = Counter(sampler.draw() for _ in range(draws))
+    assert 'f' not in counts
+    assert len(sampler) == len(WEIGHTS) - 1
+
+    total = sum(WEIGHTS.values()) - WEIGHTS['f'] - WEIGHTS['a'] + 20.0
+    expected = draws * 20.0 / total
+    assert abs(counts['a'] - expected) < 0.05 * expected
+
+
+def test_sample_respects_exclude_and_restores_weights():
+    random.seed(3)
+    sampler = make_sampler()
+    exclude = {'f', 'd', 'missing'}
+
+    for _ in range(2000):
+        drawn = sampler.sample(3, exclude)
+        assert len(drawn) == 3
+        assert len(set(drawn)) == 3
+        assert not exclude.intersection(drawn)
+
+    # Исключённые и выбранные элементы возвращаются с прежними весами
+    assert sampler.weights == WEIGHTS
+
+
+def test_sample_without_replacement_follows_weights():
+    """Первый из выбранных элементов распределён пропорционально весам оставшихся"""
+    random.seed(4)
+    sampler = make_sampler()
+    draws = 50000
+    counts = Counter(sampler.sample(2, {'f'})[0] for _ in range(draws))
+
+    total = sum(WEIGHTS.values()) - WEIGHTS['f']
+    for item, weight in WEIGHTS.items():
+        if item == 'f':
+            assert counts[item] == 0
+            continue
+        expected = draws * weight / total
+        assert abs(counts[item] - expected) < 0.05 * expected + 50, item
+
+
+def test_sample_returns_everything_when_k_exceeds_size():
+    sampler = make_sampler()
+    assert sorted(sampler.sample(10, {'a'})) == sorted(set(WEIGHTS) - {'a'})
+    assert sampler.sample(0) == []
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+
+from votelog import ABANDONED_SEGMENT_SECONDS, VoteLog
+
+
+def record(chat_id: int, minute: int) -> dict:
+    return {'chat': chat_id, 'time': f"2026-01-01T10:{minute:02d}:00+03:00",
+            'options': ["A", "B"], 'counts': [1, 0], 'winners': ["A"]}
+
+
+def write(log: VoteLog, *records: dict):
+    for item in records:
+        log.append(item)
+    asyncio.run(log.flush())
+
+
+def age(path: str, seconds: float):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_export_merges_prefixes_by_time(tmp_path):
+    # Чат сначала жил в одном процессе, потом в воркере, потом снова в одном процессе
+    single = VoteLog(str(tmp_path), "votes")
+    worker = VoteLog(str(tmp_path), "votes-1")
+    write(single, record(7, 1), record(8, 2))
+    write(worker, record(7, 3), record(7, 4))
+    write(single, record(7, 5))
+
+    assert [item['time'][14:16] for item in single.records(7)] == ["01", "03", "04", "05"]
+
+
+def test_compact_handles_abandoned_prefixes(tmp_path):
+    directory = str(tmp_path)
+    # Сегменты воркера из прежней конфигурации: закрытый и последний, давно не менявшийся
+    old = VoteLog(directory, "votes-3", segment_bytes=1)
+    write(old, record(7, 1))
+    write(old, record(7, 2))
+    live = VoteLog(directory, "votes-2")
+    write(live, record(7, 3))
+    age(os.path.join(directory, "votes-3-000002.jsonl"), ABANDONED_SEGMENT_SECONDS + 60)
+
+    current = VoteLog(directory, "votes")
+    asyncio.run(current.compact())
+
+    assert sorted(os.listdir(directory)) == [
+        "votes-2-000001.jsonl",  # последний сегмент работающего процесса не трогаем
+        "votes-3-000001.jsonl.gz",
+        "votes-3-000002.jsonl.gz",
+    ]
+    assert [item['time'][14:16] for item in current.records(7)] == ["01", "02", "03"]
+
+    # Процесс с тем же префиксом продолжает писать в новый сегмент, а не рядом с архивом
+    write(VoteLog(directory, "votes-3"), record(7, 4))
+    assert "votes-3-000003.jsonl" in os.listdir(directory)
+    assert [item['time'][14:16] for item in current.records(7)] == ["01", "02", "03", "04"]
+
+
+def test_retention_ignores_prefix(tmp_path):
+    directory = str(tmp_path)
+    write(VoteLog(directory, "votes-5"), record(7, 1))
+    write(VoteLog(directory, "votes-1"), record(7, 2))
+    age(os.path.join(directory, "votes-5-000001.jsonl"), 3 * 86400)
+
+    current = VoteLog(directory, "votes", retention_days=2)
+    asyncio.run(current.compact())
+
+    assert os.listdir(directory) == ["votes-1-000001.jsonl"]
@@ -0,0 +1,208 @@
+import asyncio
+import csv
+import gzip
+import heapq
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сегмент: <префикс>-<номер>.jsonl, после сжатия - .jsonl.gz
+SEGMENT_RE = re.compile(r"(?P<prefix>.+)-(?P<number>\d{6})\.jsonl(?P<gz>\.gz)?")
+# Последний сегмент чужого префикса без записей дольше этого считается брошенным:
+# его процесса уже нет, например после уменьшения WORKERS
+ABANDONED_SEGMENT_SECONDS = 86400
+
+
+class VoteLog:
+    """Журнал завершённых голосований: JSON-строки в сегментах с ротацией
+
+    Записи копятся в памяти и дописываются в текущий сегмент при flush в
+    отдельном потоке. Сегмент больше segment_bytes закрывается и больше не
+    меняется; compact сжимает закрытые сегменты и удаляет те, что старше
+    retention_days. У каждого процесса свой префикс сегментов, а сжатие,
+    срок хранения и чтение охватывают сегменты всех префиксов каталога, в
+    том числе оставшиеся от процессов прежней конфигурации.
+
+    directory=None - журнал не ведётся.
+    """
+
+    def __init__(self, directory: Optional[str], prefix: str = "votes",
+                 segment_bytes: int = 1 << 20, retention_days: float = 0):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.retention_days = retention_days  # 0 - хранить всё
+        self._pending: List[str] = []
+        self._lock = threading.Lock()  # запись и сжатие сегментов этого процесса
+        self._flush_lock = asyncio.Lock()
+        self._number = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            numbers = [
+                int(match['number']) for match in map(SEGMENT_RE.fullmatch, os.listdir(directory))
+                if match and match['prefix'] == prefix
+            ]
+            # Продолжаем последний сегмент, если он ещё не сжат и не переполнен
+            self._number = max(numbers, default=0)
+            if not numbers or not os.path.exists(self._segment_path(self._number)):
+                self._number += 1
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{number:06d}.jsonl")
+
+    def append(self, record: dict):
+        """Добавить запись о голосовании, на диск она попадёт при flush"""
+        if self.enabled:
+            self._pending.append(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def flush(self):
+        """Дописать накопленные записи в текущий сегмент"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            lines, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except Exception as e:
+                logger.error(f"Error writing vote log: {e}")
+                self._pending = lines + self._pending
+
+    def _write(self, lines: List[str]):
+        with self._lock:
+            path = self._segment_path(self._number)
+            # Сегмент, простоявший долго, мог сжать другой процесс - тогда начинаем следующий
+            while os.path.exists(path + ".gz") or (
+                    os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes):
+                self._number += 1
+                path = self._segment_path(self._number)
+            with open(path, "a", encoding="utf-8") as segment:
+                segment.writelines(lines)
+
+    async def compact(self):
+        """Сжать закрытые сегменты и удалить устаревшие"""
+        if self.enabled:
+            await asyncio.to_thread(self._compact)
+
+    def _compact(self):
+        now = time.time()
+        deadline = now - self.retention_days * 86400
+        segments = []  # (префикс, номер, имя)
+        for name in os.listdir(self.directory):
+            match = SEGMENT_RE.fullmatch(name)
+            if match:
+                segments.append((match['prefix'], int(match['number']), name))
+        last = {}  # префикс: номер последнего сегмента
+        for prefix, number, _ in segments:
+            last[prefix] = max(last.get(prefix, 0), number)
+
+        for prefix, number, name in sorted(segments):
+            path = os.path.join(self.directory, name)
+            with self._lock:
+                try:
+                    if self.retention_days and os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        continue
+                    if name.endswith(".gz"):
+                        continue
+                    # Текущий сегмент ещё дописывается, свой или другого живого процесса
+                    if prefix == self.prefix:
+                        if number >= self._number:
+                            continue
+                    elif number == last[prefix] and os.path.getmtime(path) > now - ABANDONED_SEGMENT_SECONDS:
+                        continue
+                    self._gzip(path)
+                except FileNotFoundError:
+                    # Сегмент уже сжал или удалил другой процесс
+                    continue
+
+    @staticmethod
+    def _gzip(path: str):
+        # Пишем во временный файл и переименовываем, чтобы читатели не увидели неполный архив;
+        # имя временного файла своё у каждого процесса, чужие сегменты могут сжимать одновременно
+        temporary = f"{path}.gz.{os.getpid()}.tmp"
+        with open(path, "rb") as source, gzip.open(temporary, "wb") as target:
+            while chunk := source.read(1 << 16):
+                target.write(chunk)
+        os.utime(temporary, (os.path.getatime(path), os.path.getmtime(path)))
+        os.replace(temporary, path + ".gz")
+        os.remove(path)
+
+    def records(self, chat_id: int) -> Iterator[dict]:
+        """Записи чата из всех сегментов каталога по времени, без загрузки истории в память"""
+        names = {}  # сегмент без .gz: (префикс, номер, имя файла)
+        for name in os.listdir(self.directory):
+            match = SEGMENT_RE.fullmatch(name)
+            if match:
+                # Пока сжатие не удалило исходник, читаем уже готовый архив
+                base = name[:-3] if match['gz'] else name
+                if match['gz'] or base not in names:
+                    names[base] = (match['prefix'], int(match['number']), name)
+
+        prefixes = defaultdict(list)  # префикс: имена сегментов по номерам
+        for prefix, _, name in sorted(names.values()):
+            prefixes[prefix].append(name)
+        # Внутри префикса записи идут по времени, а чат мог переходить между процессами,
+        # поэтому потоки префиксов сливаются по времени записи. Время записано в одной
+        # временной зоне и сравнивается как строка
+        streams = [self._read(chat_id, segment_names) for segment_names in prefixes.values()]
+        return heapq.merge(*streams, key=lambda record: record['time'])
+
+    def _read(self, chat_id: int, names: List[str]) -> Iterator[dict]:
+        for name in names:
+            path = os.path.join(self.directory, name)
+            # Исходник, сжатый после просмотра каталога, читаем из архива
+            candidates = [path] if path.endswith(".gz") else [path, path + ".gz"]
+            for candidate in candidates:
+                try:
+                    opener = gzip.open if candidate.endswith(".gz") else open
+                    with opener(candidate, "rt", encoding="utf-8") as segment:
+                        for line in segment:
+                            if not line.endswith("\n"):
+                                continue  # строка, которую сейчас дописывают
+                            record = json.loads(line)
+                            if record['chat'] == chat_id:
+                                yield record
+                    break
+                except FileNotFoundError:
+                    # Сегмент удалён по сроку хранения
+                    continue
+
+    def export(self, chat_id: int, fmt: str) -> Optional[str]:
+        """Выгрузить записи чата во временный файл csv или jsonl, None - записей нет"""
+        handle, path = tempfile.mkstemp(suffix="." + fmt)
+        count = 0
+        with os.fdopen(handle, "w", encoding="utf-8", newline="") as output:
+            if fmt == "csv":
+                # Строка на вариант опроса - удобно для сводных таблиц
+                writer = csv.writer(output)
+                writer.writerow(["time", "option", "votes", "won"])
+                for record in self.records(chat_id):
+                    count += 1
+                    winners = set(record['winners'])
+                    for option, votes in zip(record['options'], record['counts']):
+                        writer.writerow([record['time'], option, votes, int(option in winners)])
+                    # Карты, выпавшие вместо варианта случайной карты
+                    for winner in winners.difference(record['options']):
+                        writer.writerow([record['time'], winner, "", 1])
+            else:
+                for record in self.records(chat_id):
+                    count += 1
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        if not count:
+            os.remove(path)
+            return None
+        return path